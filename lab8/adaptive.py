@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import numpy as np
+
+from batch import BatchRenderer
+
+
+def luminance(colors: np.ndarray) -> np.ndarray:
+    return 0.2126 * colors[0] + 0.7152 * colors[1] + 0.0722 * colors[2]
+
+
+def heatmap(counts: np.ndarray, max_samples: int) -> np.ndarray:
+    # Чёрный -> красный -> жёлтый -> белый по числу сэмплов
+    t = np.clip(counts / max_samples, 0, 1) * 3
+    return (np.clip(np.stack((t, t - 1, t - 2), axis=-1), 0, 1) * 255).astype(np.uint8)
+
+
+class AdaptiveSampler:
+    __slots__ = ('min_samples', 'max_samples', 'threshold', 'step')
+
+    def __init__(self, min_samples: int = 4, max_samples: int = 64, threshold: float = 0.01, step: int = 4):
+        self.min_samples = max(min_samples, 2)
+        self.max_samples = max(max_samples, self.min_samples)
+        self.threshold = threshold
+        self.step = step
+
+    def __repr__(self) -> str:
+        return f"AdaptiveSampler(samples: {self.min_samples}..{self.max_samples}, threshold: {self.threshold})"
+
+    def render(self, renderer: BatchRenderer, x0: int, y0: int, x1: int, y1: int,
+               seed: int, first: int = 0) -> tuple:
+        ys, xs = np.mgrid[y0:y1, x0:x1]
+        xs, ys = xs.ravel().astype(np.float64), ys.ravel().astype(np.float64)
+        color_sum = np.zeros((3, xs.size))
+        # Сумма и сумма квадратов яркости после обрезки в [0, 1]: ошибку считаем в том, что попадёт на экран
+        luminance_sum = np.zeros(xs.size)
+        luminance_square = np.zeros(xs.size)
+        counts = np.zeros(xs.size, dtype=np.int64)
+        offsets = np.arange(self.max_samples)
+
+        active, samples = np.arange(xs.size), self.min_samples
+        while active.size:
+            # Все сэмплы раунда одной пачкой: (3, активные пиксели, сэмплы)
+            indices = first + (counts[active, None] + offsets[:samples]).ravel()
+            colors = renderer.sample(np.repeat(xs[active], samples), np.repeat(ys[active], samples), indices, seed)
+            colors = colors.reshape(3, active.size, samples)
+            color_sum[:, active] += colors.sum(axis=2)
+            value = np.clip(luminance(colors), 0, 1)
+            luminance_sum[active] += value.sum(axis=1)
+            luminance_square[active] += (value * value).sum(axis=1)
+            counts[active] += samples
+
+            # У всех активных пикселей одинаковое число сэмплов
+            n = counts[active[0]]
+            mean = luminance_sum[active] / n
+            variance = np.maximum(luminance_square[active] / n - mean * mean, 0) * n / (n - 1)
+            error = np.sqrt(variance / n)
+            if n >= self.max_samples:
+                break
+            active = active[error > self.threshold]
+            samples = min(self.step, self.max_samples - n)
+
+        colors = (color_sum / counts).T.reshape(y1 - y0, x1 - x0, 3).astype(np.float32)
+        return colors, counts.reshape(y1 - y0, x1 - x0)
@@ -0,0 +1,443 @@
+from __future__ import annotations
+
+from time import perf_counter
+
+import numpy as np
+
+from objects import Sphere, SphereSet, InfinityChessBoard
+from vector import Vector
+from bvh import BVH
+from mesh import Mesh, MeshInstances
+from sequences import RandomSequence, path_keys, roulette, light_sample
+from light import LightSet, PointLight
+
+# Лучи хранятся как structure-of-arrays: массивы формы (3, n), по строке на компоненту
+
+# До стольких сфер перебор дешевле обхода дерева
+brute_force_limit = 8
+
+
+def column(vector: Vector) -> np.ndarray:
+    return np.array([[vector.x], [vector.y], [vector.z]], dtype=np.float64)
+
+
+def dot(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+
+def normalize(a: np.ndarray) -> np.ndarray:
+    return a / np.sqrt(dot(a, a))
+
+
+def reflect(directions: np.ndarray, normals: np.ndarray) -> np.ndarray:
+    return directions - normals * (2 * dot(directions, normals))
+
+
+def sphere_distance(centers: np.ndarray, radii: np.ndarray, origins: np.ndarray,
+                    directions: np.ndarray) -> np.ndarray:
+    l = centers - origins
+    adj = dot(l, directions)
+    d2 = dot(l, l) - adj * adj
+    radius2 = radii * radii
+    thc = np.sqrt(np.maximum(radius2 - d2, 0))
+    t = np.where(adj - thc > 0, adj - thc, adj + thc)
+    return np.where((d2 <= radius2) & (t > 0), t, np.inf)
+
+
+def to_rgb(colors: np.ndarray) -> np.ndarray:
+    return (np.clip(colors, 0, 1) * 255).astype(np.uint8)
+
+
+class RayBatch:
+    __slots__ = ('origins', 'directions', 't', 'ids', 'primitives')
+
+    def __init__(self, origins: np.ndarray, directions: np.ndarray):
+        self.origins = origins
+        self.directions = directions
+        self.t = np.full(origins.shape[1], np.inf)
+        self.ids = np.full(origins.shape[1], -1, dtype=np.int32)
+        # Номер треугольника для попаданий в сетки
+        self.primitives = np.full(origins.shape[1], -1, dtype=np.int64)
+
+    def __repr__(self) -> str:
+        return f"RayBatch(size: {len(self)})"
+
+    def __len__(self) -> int:
+        return self.t.size
+
+    def hit(self) -> np.ndarray:
+        return self.ids >= 0
+
+
+class BatchRenderer:
+    __slots__ = ('objects', 'camera', 'lights', 'skybox', 'shadow_bias', 'max_reflections', 'chunk_size', 'sequence',
+                 'min_throughput', 'roulette_depth', 'light_samples', 'light_points', 'light_vectors', 'light_strength',
+                 'light_diffuse', 'light_specular', 'light_ambient', 'materials', 'diffuse', 'specular', 'ambient',
+                 'shininess', 'reflectivity', 'rays', 'stats', 'is_sphere', 'sphere_objects', 'sphere_materials',
+                 'centers', 'radii', 'tree', 'planes', 'meshes')
+
+    def __init__(self, objects: list, lights, camera, skybox, shadow_bias: float = 0.0001, max_reflections: int = 6,
+                 chunk_size: int = 1 << 16, sequence=None, min_throughput: float = 0.01, roulette_depth: int = 2,
+                 light_samples: int = 1):
+        self.objects = objects
+        self.camera = camera
+        self.skybox = skybox
+        self.shadow_bias = shadow_bias
+        self.max_reflections = max_reflections
+        self.chunk_size = chunk_size
+        # Источник сэмплов пикселя и апертуры: RandomSequence, StratifiedSequence, HaltonSequence, SobolSequence
+        self.sequence = sequence or RandomSequence()
+        # Путь обрывается, когда его вклад меньше min_throughput; начиная с roulette_depth - русской рулеткой
+        self.min_throughput = min_throughput
+        self.roulette_depth = roulette_depth
+        # Теневых лучей на точку попадания; если источников больше, они выбираются пропорционально мощности
+        self.light_samples = max(light_samples, 1)
+        self.set_lights(lights)
+        self.rays = 0
+        # RenderStats для отчёта о лучах и этапах; None - сбор выключен
+        self.stats = None
+
+        # Сферы уходят в BVH, бесконечные доски проверяются отдельно, у сетки и набора её копий своё дерево
+        for obj in objects:
+            if not isinstance(obj, (Sphere, SphereSet, InfinityChessBoard, Mesh, MeshInstances)):
+                raise TypeError(f"Unsupported object for batch rendering: {obj!r}")
+        self.set_materials(objects)
+        singles = [i for i, obj in enumerate(objects) if isinstance(obj, Sphere)]
+        centers = [np.hstack([column(objects[i].center) for i in singles]) if singles else np.zeros((3, 0))]
+        radii = [np.array([objects[i].radius for i in singles], dtype=np.float64)]
+        sphere_objects = [np.array(singles, dtype=np.int32)]
+        sphere_materials = [np.array(singles, dtype=np.int64)]
+        palette = len(objects)
+        for i, obj in enumerate(objects):
+            if isinstance(obj, SphereSet):
+                centers.append(obj.centers)
+                radii.append(obj.radii)
+                sphere_objects.append(np.full(len(obj), i, dtype=np.int32))
+                sphere_materials.append(obj.material_indices + palette)
+                palette += len(obj.materials)
+        self.is_sphere = np.array([isinstance(obj, (Sphere, SphereSet)) for obj in objects])
+        # Номер сферы в общих массивах = номер примитива в попадании
+        self.centers = np.concatenate(centers, axis=1).astype(np.float64)
+        self.radii = np.concatenate(radii).astype(np.float64)
+        self.sphere_objects = np.concatenate(sphere_objects)
+        self.sphere_materials = np.concatenate(sphere_materials)
+        self.tree = BVH((self.centers - self.radii).T, (self.centers + self.radii).T) \
+            if self.radii.size > brute_force_limit else None
+        self.planes = [(i, obj.y) for i, obj in enumerate(objects) if isinstance(obj, InfinityChessBoard)]
+        self.meshes = [(i, obj) for i, obj in enumerate(objects) if isinstance(obj, (Mesh, MeshInstances))]
+
+    def __repr__(self) -> str:
+        return f"BatchRenderer(objects: {len(self.objects)}, max_reflections: {self.max_reflections})"
+
+    def set_lights(self, lights):
+        self.lights = LightSet(list(lights) if isinstance(lights, (list, tuple)) else [lights])
+        self.light_points = np.array([isinstance(light, PointLight) for light in self.lights.lights])
+        # Для точечного источника - позиция, для направленного - единичный вектор на свет
+        self.light_vectors = np.hstack([column(light.position) if isinstance(light, PointLight)
+                                        else -normalize(column(light.direction)) for light in self.lights.lights])
+        self.light_strength = np.array([light.strength for light in self.lights.lights], dtype=np.float64)
+        self.light_diffuse = np.hstack([column(light.diffuse_color) for light in self.lights.lights])
+        self.light_specular = np.hstack([column(light.specular_color) for light in self.lights.lights])
+        self.light_ambient = np.hstack([column(light.ambient_color) for light in self.lights.lights])
+
+    def set_materials(self, objects: list):
+        # Материалы: сначала по одному на объект (номер материала = номер объекта), затем палитры наборов сфер.
+        # Строка самого набора не используется: его сферы всегда берут материал из палитры.
+        # Повторный вызов меняет только параметры: число материалов должно остаться тем же
+        materials = [obj.materials[0] if isinstance(obj, SphereSet) else obj for obj in objects]
+        for obj in objects:
+            if isinstance(obj, SphereSet):
+                materials += obj.materials
+        if len(materials) != len(getattr(self, 'materials', materials)):
+            raise ValueError(f"Expected {len(self.materials)} materials, got {len(materials)}")
+        self.materials = materials
+        self.diffuse = np.hstack([column(material.diffuse_color) for material in materials])
+        self.specular = np.hstack([column(material.specular_color) for material in materials])
+        self.ambient = np.hstack([column(material.ambient_color) for material in materials])
+        self.shininess = np.array([material.shininess for material in materials], dtype=np.float64)
+        self.reflectivity = np.array([material.reflectivity for material in materials], dtype=np.float64)
+
+    def primary_rays(self, xs: np.ndarray, ys: np.ndarray, lens: np.ndarray) -> RayBatch:
+        # Произвольные (дрожащие) координаты на экране: аналитически дешевле, чем выборка из таблицы направлений
+        half_width, half_height, z = self.camera.get_projection()
+        directions = normalize(np.stack((xs - half_width, ys - half_height, np.full(xs.shape, -z))))
+        return self.lens_rays(directions, lens)
+
+    def pixel_rays(self, xs: np.ndarray, ys: np.ndarray, lens: np.ndarray | None = None) -> RayBatch:
+        # Лучи через центры целых пикселей прямо из кешированной таблицы камеры
+        directions = self.camera.get_table()[:, ys, xs].astype(np.float64)
+        return self.lens_rays(directions, lens)
+
+    def lens_rays(self, directions: np.ndarray, lens: np.ndarray | None) -> RayBatch:
+        # lens в [0, 1) - положение точки на краю апертуры; без него камера считается точечной
+        camera = self.camera
+        position = column(camera.position)
+        size = directions.shape[1]
+        if camera.aperture > 0 and lens is not None:
+            angle = lens * (2 * np.pi)
+            rd = np.stack((np.cos(angle), np.sin(angle), np.zeros(size))) * (camera.aperture / 2)
+            focal_points = position + directions * camera.focus_distance
+            origins = position + rd
+            directions = normalize(focal_points - origins)
+        else:
+            origins = np.repeat(position, size, axis=1)
+        return RayBatch(origins, directions)
+
+    def intersect(self, rays: RayBatch, any_hit: bool = False) -> RayBatch:
+        self.rays += len(rays)
+        if self.stats is not None:
+            self.stats.counters['plane_tests'] += len(rays) * len(self.planes)
+            self.stats.counters['mesh_queries'] += len(rays) * len(self.meshes)
+            if self.tree is None:
+                self.stats.counters['sphere_tests'] += len(rays) * self.radii.size
+        origins, directions = rays.origins, rays.directions
+        for index, y in self.planes:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                distance = (y - origins[1]) / directions[1]
+            hit = (directions[1] > 0) & (distance > 0) & (distance < rays.t)
+            rays.t[hit] = distance[hit]
+            rays.ids[hit] = index
+        if self.tree is not None:
+            active = np.flatnonzero(rays.ids < 0) if any_hit else np.arange(len(rays))
+            t = rays.t[active]
+            primitives = np.full(active.size, -1, dtype=np.int64)
+            self.tree.intersect(origins[:, active], directions[:, active], t, primitives, self.sphere_distance,
+                                any_hit)
+            hit = primitives >= 0
+            rays.t[active[hit]] = t[hit]
+            rays.ids[active[hit]] = self.sphere_objects[primitives[hit]]
+            rays.primitives[active[hit]] = primitives[hit]
+        else:
+            for sphere, index in enumerate(self.sphere_objects):
+                distance = sphere_distance(self.centers[:, sphere:sphere + 1], self.radii[sphere], origins,
+                                           directions)
+                hit = distance < rays.t
+                rays.t[hit] = distance[hit]
+                rays.ids[hit] = index
+                rays.primitives[hit] = sphere
+        for index, mesh in self.meshes:
+            active = np.flatnonzero(rays.ids < 0) if any_hit else np.arange(len(rays))
+            t, triangles = mesh.intersect(origins[:, active], directions[:, active], rays.t[active], any_hit)
+            hit = triangles >= 0
+            rays.t[active[hit]] = t[hit]
+            rays.ids[active[hit]] = index
+            rays.primitives[active[hit]] = triangles[hit]
+        return rays
+
+    def sphere_distance(self, origins: np.ndarray, directions: np.ndarray, primitives: np.ndarray) -> np.ndarray:
+        if self.stats is not None:
+            self.stats.counters['sphere_tests'] += primitives.size
+        return sphere_distance(self.centers[:, primitives], self.radii[primitives], origins, directions)
+
+    def get_normals(self, rays: RayBatch, points: np.ndarray, hit: np.ndarray) -> np.ndarray:
+        ids = rays.ids[hit]
+        normals = np.empty_like(points)
+        mask = self.is_sphere[ids]
+        normals[:, mask] = normalize(points[:, mask] - self.centers[:, rays.primitives[hit][mask]])
+        for index, _ in self.planes:
+            normals[:, ids == index] = column(self.objects[index].get_normal(None))
+        for index, mesh in self.meshes:
+            mask = ids == index
+            normals[:, mask] = mesh.get_normals(rays.primitives[hit][mask], rays.directions[:, hit][:, mask])
+        return normals
+
+    def get_materials(self, rays: RayBatch, hit: np.ndarray) -> np.ndarray:
+        # Номер материала попадания: у объекта он свой, у сферы из набора - из её палитры
+        ids = rays.ids[hit]
+        materials = ids.astype(np.int64)
+        mask = self.is_sphere[ids]
+        materials[mask] = self.sphere_materials[rays.primitives[hit][mask]]
+        return materials
+
+    def occluded(self, origins: np.ndarray, directions: np.ndarray, distances: np.ndarray | None = None) -> np.ndarray:
+        # distances - до источника: препятствия за точечным светом тени не дают
+        rays = RayBatch(origins, directions)
+        if distances is not None:
+            rays.t = distances.copy()
+        if self.stats is None:
+            return self.intersect(rays, any_hit=True).hit()
+        start = perf_counter()
+        blocked = self.intersect(rays, any_hit=True).hit()
+        self.stats.counters['shadow_rays'] += blocked.size
+        self.stats.counters['shadow_hits'] += int(np.count_nonzero(blocked))
+        self.stats.stages['shadow'] += perf_counter() - start
+        return blocked
+
+    def shade(self, points: np.ndarray, normals: np.ndarray, materials: np.ndarray, keys: np.ndarray,
+              depth: int = 0) -> np.ndarray:
+        # Не больше light_samples теневых лучей на точку. Если источников не больше бюджета, считаются все,
+        # иначе каждый сэмпл берёт источник с вероятностью pdf и делит его вклад на pdf.
+        # keys - ключи путей (path_keys): с общим ключом все точки выбрали бы один источник, и шум стал бы полосами
+        color = np.zeros(points.shape)
+        if len(self.lights) <= self.light_samples:
+            for light in range(len(self.lights)):
+                color += self.shade_light(points, normals, materials, np.full(materials.size, light))
+            return color
+        for sample in range(self.light_samples):
+            lights = self.lights.sample(light_sample(keys, depth, sample))
+            color += self.shade_light(points, normals, materials, lights) / self.lights.pdf[lights]
+        return color / self.light_samples
+
+    def shade_light(self, points: np.ndarray, normals: np.ndarray, materials: np.ndarray,
+                    lights: np.ndarray) -> np.ndarray:
+        # У каждой точки свой источник lights[i]; точечный светит из своей позиции с затуханием 1 / d^2
+        light_dir = self.light_vectors[:, lights]
+        distances = np.full(lights.size, np.inf)
+        falloff = np.ones(lights.size)
+        point = self.light_points[lights]
+        if point.any():
+            offsets = light_dir[:, point] - points[:, point]
+            squared = dot(offsets, offsets)
+            distances[point] = np.sqrt(squared)
+            light_dir[:, point] = offsets / distances[point]
+            falloff[point] = 1 / np.maximum(squared, 1e-8)
+        strength = self.light_strength[lights]
+
+        # Ambient component
+        ambient = self.ambient[:, materials] * self.light_ambient[:, lights]
+
+        # Diffuse component
+        n_dot_l = dot(normals, light_dir)
+        diffuse = self.diffuse[:, materials] * self.light_diffuse[:, lights] * (np.maximum(n_dot_l, 0) * strength)
+
+        # Specular component
+        view_dir = normalize(column(self.camera.position) - points)
+        reflect_dir = normals * (2 * n_dot_l) - light_dir
+        specular_intensity = np.maximum(dot(view_dir, reflect_dir), 0) ** self.shininess[materials]
+        specular = self.specular[:, materials] * self.light_specular[:, lights] * specular_intensity
+
+        color = ambient + diffuse + specular
+
+        # Shadows
+        blocked = self.occluded(points + normals * self.shadow_bias, light_dir, distances)
+        lit = n_dot_l * strength
+        return color * (np.where(blocked, 0.1 / strength, lit) * falloff)
+
+    def trace(self, rays: RayBatch, keys: np.ndarray, depth: int = 0) -> tuple:
+        # keys - ключи путей лучей, как в radiance(); здесь они нужны только для случайного выбора источников света
+        stats = self.stats
+        if stats is not None:
+            start = perf_counter()
+        self.intersect(rays)
+        hit = rays.hit()
+        colors = np.zeros(rays.origins.shape)
+        points = np.zeros(rays.origins.shape)
+        normals = np.zeros(rays.origins.shape)
+        if stats is not None:
+            hits = int(np.count_nonzero(hit))
+            stats.counters['hits'] += hits
+            stats.counters['misses'] += hit.size - hits
+            stats.stages['intersect'] += perf_counter() - start
+            start = perf_counter()
+            shadow = stats.stages['shadow']
+        if hit.any():
+            points[:, hit] = rays.origins[:, hit] + rays.directions[:, hit] * rays.t[hit]
+            normals[:, hit] = self.get_normals(rays, points[:, hit], hit)
+            colors[:, hit] = self.shade(points[:, hit], normals[:, hit], self.get_materials(rays, hit), keys[hit],
+                                        depth)
+        if stats is not None:
+            # Время теневых лучей уже учтено в occluded
+            stats.stages['shade'] += perf_counter() - start - (stats.stages['shadow'] - shadow)
+            start = perf_counter()
+        if not hit.all():
+            colors[:, ~hit] = self.skybox.get_image_colors(rays.directions[:, ~hit])
+        if stats is not None:
+            stats.counters['sky_lookups'] += hit.size - hits
+            stats.stages['sky'] += perf_counter() - start
+        return colors, points, normals, hit
+
+    def radiance(self, rays: RayBatch, keys: np.ndarray) -> np.ndarray:
+        # Итеративный интегратор: цвет пути - сумма освещения в точках попадания, взвешенная throughput,
+        # то есть произведением reflectivity пройденных поверхностей. keys - ключи путей для рулетки
+        if self.stats is not None:
+            self.stats.counters['primary_rays'] += len(rays)
+        return self.follow(rays, keys, np.zeros(rays.origins.shape), np.ones(len(rays)), np.arange(len(rays)))
+
+    def follow(self, rays: RayBatch, keys: np.ndarray, colors: np.ndarray, throughput: np.ndarray, index: np.ndarray,
+               depth: int = 0) -> np.ndarray:
+        # Продолжение путей index с глубины depth: rays[i] - луч пути index[i], вклад добавляется в colors
+        for depth in range(depth, self.max_reflections + 1):
+            new_colors, points, normals, hit = self.trace(rays, keys[index], depth)
+            colors[:, index] += new_colors * throughput[index]
+            if depth == self.max_reflections:
+                break
+            index, rays = self.scatter(rays.directions[:, hit], points[:, hit], normals[:, hit],
+                                       self.get_materials(rays, hit), index[hit], keys, throughput, depth)
+            if not index.size:
+                break
+        return colors
+
+    def scatter(self, directions: np.ndarray, points: np.ndarray, normals: np.ndarray, materials: np.ndarray,
+                index: np.ndarray, keys: np.ndarray, throughput: np.ndarray, depth: int) -> tuple:
+        # Отражённые лучи из попаданий путей index; throughput умножается на reflectivity на месте
+        throughput[index] *= self.reflectivity[materials]
+        alive = throughput[index] >= self.min_throughput
+        if depth >= self.roulette_depth:
+            # Выживший путь делим на вероятность выживания, чтобы среднее не смещалось
+            survival = np.minimum(throughput[index], 1)
+            alive &= roulette(keys[index], depth) < survival
+            throughput[index] /= np.where(alive, survival, 1)
+        index = index[alive]
+        directions = normalize(reflect(directions[:, alive], normals[:, alive]))
+        if self.stats is not None:
+            self.stats.counters['reflection_rays'] += index.size
+        return index, RayBatch(points[:, alive] + directions * self.shadow_bias, directions)
+
+    def sample(self, xs: np.ndarray, ys: np.ndarray, indices: np.ndarray, seed: int) -> np.ndarray:
+        # Один сэмпл на каждую пару координат, indices - номер сэмпла в своём пикселе; пачками по chunk_size лучей
+        colors = np.empty((3, xs.size))
+        for start in range(0, xs.size, self.chunk_size):
+            part = slice(start, start + self.chunk_size)
+            if self.stats is not None:
+                begin = perf_counter()
+            points = self.sequence.sample(xs[part], ys[part], indices[part], seed)
+            rays = self.primary_rays(xs[part] + points[0] - 0.5, ys[part] + points[1] - 0.5, points[2])
+            if self.stats is not None:
+                self.stats.stages['primary'] += perf_counter() - begin
+            colors[:, part] = self.radiance(rays, path_keys(seed, xs[part], ys[part], indices[part]))
+        return colors
+
+    def render(self, x0: int, y0: int, x1: int, y1: int, samples: int, seed: int, first: int = 0,
+               variance: bool = False) -> np.ndarray | tuple:
+        # Сэмплы first .. first + samples - 1 каждого пикселя. С variance вторым значением идёт дисперсия
+        # средней яркости пикселя (h, w) - по ней денойзер отличает шум от деталей
+        ys, xs = np.mgrid[y0:y1, x0:x1]
+        xs, ys = xs.ravel().astype(np.float64), ys.ravel().astype(np.float64)
+        color_sum = np.zeros((3, xs.size))
+        luminance_square = np.zeros(xs.size)
+        for index in range(first, first + samples):
+            colors = self.sample(xs, ys, np.full(xs.size, index), seed)
+            color_sum += colors
+            if variance:
+                luminance_square += (0.2126 * colors[0] + 0.7152 * colors[1] + 0.0722 * colors[2]) ** 2
+        shape = (y1 - y0, x1 - x0)
+        image = (color_sum / samples).T.reshape(*shape, 3).astype(np.float32)
+        if not variance:
+            return image
+        mean = (0.2126 * color_sum[0] + 0.7152 * color_sum[1] + 0.0722 * color_sum[2]) / samples
+        luminance_variance = np.maximum(luminance_square / samples - mean * mean, 0) / max(samples - 1, 1)
+        return image, luminance_variance.reshape(shape).astype(np.float32)
+
+    def aovs(self, x0: int, y0: int, x1: int, y1: int, samples: int, seed: int) -> tuple:
+        # Первое попадание сэмплов 0 .. samples - 1, усреднённое как цвет: альбедо (цвет неба при промахе),
+        # нормаль (0 при промахе) и расстояние вдоль луча (0 при промахе). Тени и отражения не трассируются
+        ys, xs = np.mgrid[y0:y1, x0:x1]
+        xs, ys = xs.ravel().astype(np.float64), ys.ravel().astype(np.float64)
+        albedo = np.zeros((3, xs.size))
+        normals = np.zeros((3, xs.size))
+        depth = np.zeros(xs.size)
+        for index in range(samples):
+            points = self.sequence.sample(xs, ys, np.full(xs.size, index), seed)
+            rays = self.intersect(self.primary_rays(xs + points[0] - 0.5, ys + points[1] - 0.5, points[2]))
+            hit = rays.hit()
+            if hit.any():
+                hit_points = rays.origins[:, hit] + rays.directions[:, hit] * rays.t[hit]
+                albedo[:, hit] += self.diffuse[:, self.get_materials(rays, hit)]
+                normals[:, hit] += self.get_normals(rays, hit_points, hit)
+                depth[hit] += rays.t[hit]
+            if not hit.all():
+                albedo[:, ~hit] += self.skybox.get_image_colors(rays.directions[:, ~hit])
+        shape = (y1 - y0, x1 - x0)
+        return ((albedo / samples).T.reshape(*shape, 3).astype(np.float32),
+                (normals / samples).T.reshape(*shape, 3).astype(np.float32),
+                (depth / samples).reshape(shape).astype(np.float32))
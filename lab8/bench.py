@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+import json
+import platform
+import sys
+from argparse import ArgumentParser
+from timeit import Timer
+
+import numpy as np
+
+from bench_vector import CASES
+from vector import Vector
+
+# Горячие пути трассировщика без окна: время на операцию, операции и лучи в секунду.
+# Результаты пишутся в JSON, сравнение с сохранённым baseline завершает процесс с кодом 1 при замедлении
+
+
+def make_rays(count: int) -> list:
+    # Одни и те же лучи из камеры сцены через сетку экрана: часть попадает в объекты, часть в небо и доску
+    from scene import camera
+    width, height = camera.screen_size.x, camera.screen_size.y
+    side = int(np.ceil(np.sqrt(count)))
+    return [camera.get_direction(Vector((i % side + 0.5) * width / side, (i // side + 0.5) * height / side), 0.0)
+            for i in range(count)]
+
+
+def bench_vector(statement: str):
+    namespace = {'Vector': Vector, 'a': Vector(0.3, -0.5, 0.8), 'b': Vector(0.1, 0.9, -0.4)}
+    return Timer(statement, "c = Vector(0.0, 0.0, 0.0)", globals=namespace), 1, 0
+
+
+def bench_sphere():
+    from scene import objects
+    sphere, rays = objects[0], make_rays(256)
+    return Timer(lambda: [sphere.intersection(ray) for ray in rays]), len(rays), len(rays)
+
+
+def bench_chessboard():
+    from scene import objects
+    board, rays = objects[-1], make_rays(256)
+    return Timer(lambda: [board.intersection(ray) for ray in rays]), len(rays), len(rays)
+
+
+def bench_cast():
+    from tracer import tree
+    rays = make_rays(256)
+    return Timer(lambda: [ray.cast(tree) for ray in rays]), len(rays), len(rays)
+
+
+def bench_skybox():
+    from scene import skybox
+    directions = [ray.direction for ray in make_rays(256)]
+    return Timer(lambda: [skybox.get_image_coords(direction) for direction in directions]), len(directions), 0
+
+
+def bench_trace_ray():
+    from tracer import trace_ray
+    rays = make_rays(256)
+    return Timer(lambda: [trace_ray(ray) for ray in rays]), len(rays), len(rays)
+
+
+def bench_frame(width: int = 160, height: int = 100):
+    # Кадр батч-рендерером в одном процессе, 1 сэмпл на пиксель; операция - пиксель
+    import scene
+    from batch import BatchRenderer
+    from camera import Camera
+    camera = scene.camera
+    camera = Camera(camera.position, Vector(width, height), camera.fov, camera.focus_distance, camera.aperture)
+    renderer = BatchRenderer(scene.objects, scene.lights, camera, scene.skybox, scene.shadow_bias,
+                             scene.max_reflections, sequence=scene.sequence, min_throughput=scene.min_throughput,
+                             roulette_depth=scene.roulette_depth, light_samples=scene.light_samples)
+    renderer.render(0, 0, width, height, 1, 0)
+    rays, renderer.rays = renderer.rays, 0
+    return Timer(lambda: renderer.render(0, 0, width, height, 1, 0)), width * height, rays
+
+
+BENCHMARKS = {
+    **{f"vector_{name}": (bench_vector, (statement,)) for name, _, statement in CASES},
+    'sphere_intersection': (bench_sphere, ()),
+    'chessboard_intersection': (bench_chessboard, ()),
+    'ray_cast': (bench_cast, ()),
+    'skybox_lookup': (bench_skybox, ()),
+    'trace_ray': (bench_trace_ray, ()),
+    'frame_160x100': (bench_frame, ()),
+}
+
+
+def measure(name: str, repeat: int = 5) -> dict:
+    make, arguments = BENCHMARKS[name]
+    timer, ops, rays = make(*arguments)
+    # Число запусков подбирается так, чтобы замер шёл не меньше 0.2 с; берётся лучший из repeat
+    number, _ = timer.autorange()
+    seconds = min(timer.repeat(repeat, number)) / number
+    return {
+        'ns_per_op': seconds / ops * 1e9,
+        'ops_per_second': ops / seconds,
+        'rays_per_second': rays / seconds if rays else None,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    # Замедление больше tolerance (доля) считается регрессией
+    regressions = []
+    print(f"{'benchmark':<26}{'baseline, ns':>16}{'current, ns':>16}{'change':>10}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['ns_per_op'], result['ns_per_op']
+        change = new / old - 1
+        regressed = change > tolerance
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<26}{old:>16.1f}{new:>16.1f}{change:>+9.1%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def parse_args(argv: list | None = None):
+    parser = ArgumentParser(description="Benchmark the lab8 ray tracer hot paths without opening a window")
+    parser.add_argument('names', nargs='*', help=f"benchmarks to run, all by default: {', '.join(BENCHMARKS)}")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--out', default=None, help="JSON file to write the results to")
+    parser.add_argument('--baseline', default=None, help="JSON results to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="allowed slowdown against the baseline")
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name!r}")
+    return args
+
+
+def main(argv: list | None = None) -> int:
+    args = parse_args(argv)
+    results = {}
+    print(f"{'benchmark':<26}{'ns/op':>14}{'ops/s':>16}{'rays/s':>16}")
+    for name in args.names or BENCHMARKS:
+        result = results[name] = measure(name, args.repeat)
+        rays = f"{result['rays_per_second']:,.0f}" if result['rays_per_second'] else '-'
+        print(f"{name:<26}{result['ns_per_op']:>14.1f}{result['ops_per_second']:>16,.0f}{rays:>16}")
+
+    if args.out:
+        meta = {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.platform()}
+        with open(args.out, 'w') as file:
+            json.dump({'meta': meta, 'results': results}, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+        print()
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {args.tolerance:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
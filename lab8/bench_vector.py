@@ -0,0 +1,35 @@
+from __future__ import annotations
+
+from timeit import repeat
+
+from vector import Vector
+
+# Пары: выражение через операторы и то же самое через быстрые методы
+CASES = [
+    ('add', "a + b", "a.add(b)"),
+    ('sub', "a - b", "a.sub(b)"),
+    ('mul', "a * b", "a.mul(b)"),
+    ('scale', "a * 0.5", "a.scale(0.5)"),
+    ('madd', "a + b * 0.5", "a.madd(b, 0.5)"),
+    ('dot', "a.dot(b)", "a.vdot(b)"),
+    ('normalize', "a / a.magnitude()", "a.normalize()"),
+    ('accumulate', "c = c + b", "c += b"),
+    ('reflect', "a - b * (a.dot(b)) * 2", "a.reflect(b)"),
+]
+
+
+def measure(statement: str, number: int) -> float:
+    namespace = {'Vector': Vector, 'a': Vector(0.3, -0.5, 0.8), 'b': Vector(0.1, 0.9, -0.4)}
+    times = repeat(statement, "c = Vector(0.0, 0.0, 0.0)", globals=namespace, number=number, repeat=5)
+    return min(times) / number * 1e9
+
+
+def main(number: int = 200000):
+    print(f"{'operation':<12}{'operators, ns':>16}{'methods, ns':>14}{'speedup':>10}")
+    for name, old, new in CASES:
+        old_time, new_time = measure(old, number), measure(new, number)
+        print(f"{name:<12}{old_time:>16.1f}{new_time:>14.1f}{old_time / new_time:>9.2f}x")
+
+
+if __name__ == '__main__':
+    main()
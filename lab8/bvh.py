@@ -0,0 +1,286 @@
+from __future__ import annotations
+
+from math import inf
+
+import numpy as np
+
+
+def half_area(lower: np.ndarray, upper: np.ndarray) -> np.ndarray:
+    size = upper - lower
+    return size[..., 0] * size[..., 1] + size[..., 1] * size[..., 2] + size[..., 2] * size[..., 0]
+
+
+class BVH:
+    # Узлы хранятся плоскими массивами; у внутреннего узла дети лежат подряд: left и left + 1
+    __slots__ = ('lower', 'upper', 'left', 'first', 'count', 'order', 'nodes', 'depth')
+
+    def __init__(self, lower: np.ndarray, upper: np.ndarray, leaf_size: int = 4, bins: int = 16):
+        centroids = (lower + upper) / 2
+        order = np.arange(len(lower))
+        node_lower, node_upper, node_left, node_first, node_count = [None], [None], [-1], [0], [0]
+        self.depth = 1
+        stack = [(0, 0, len(order), 1)]
+        while stack:
+            node, start, end, depth = stack.pop()
+            self.depth = max(self.depth, depth)
+            index = order[start:end]
+            primitive_lower, primitive_upper = lower[index], upper[index]
+            node_lower[node] = primitive_lower.min(axis=0)
+            node_upper[node] = primitive_upper.max(axis=0)
+            mask = self.split(centroids[index], primitive_lower, primitive_upper, leaf_size, bins)
+            if mask is None:
+                node_first[node], node_count[node] = start, end - start
+                continue
+            order[start:end] = np.concatenate((index[mask], index[~mask]))
+            middle = start + int(np.count_nonzero(mask))
+            left = len(node_left)
+            node_left[node] = left
+            node_lower += [None, None]
+            node_upper += [None, None]
+            node_left += [-1, -1]
+            node_first += [0, 0]
+            node_count += [0, 0]
+            stack.append((left, start, middle, depth + 1))
+            stack.append((left + 1, middle, end, depth + 1))
+
+        self.lower = np.array(node_lower, dtype=np.float64).reshape(-1, 3)
+        self.upper = np.array(node_upper, dtype=np.float64).reshape(-1, 3)
+        self.left = np.array(node_left, dtype=np.int64)
+        self.first = np.array(node_first, dtype=np.int64)
+        self.count = np.array(node_count, dtype=np.int64)
+        self.order = order
+        # Копия узлов в виде списков питоновских чисел для скалярного обхода
+        self.nodes = list(zip(self.lower.tolist(), self.upper.tolist(), node_left, node_first, node_count))
+
+    def __repr__(self) -> str:
+        return f"BVH(primitives: {len(self.order)}, nodes: {len(self.left)}, depth: {self.depth})"
+
+    @staticmethod
+    def split(centroids: np.ndarray, lower: np.ndarray, upper: np.ndarray, leaf_size: int,
+              bins: int) -> np.ndarray | None:
+        count = len(centroids)
+        if count <= leaf_size:
+            return None
+        low, high = centroids.min(axis=0), centroids.max(axis=0)
+        axis = int(np.argmax(high - low))
+        extent = high[axis] - low[axis]
+        if extent <= 0:
+            return np.arange(count) < count // 2
+        bin_index = np.minimum(((centroids[:, axis] - low[axis]) / extent * bins).astype(np.int64), bins - 1)
+
+        # Binned SAH: раскладываем центры по корзинам вдоль длинной оси и ищем самую дешёвую границу
+        sort = np.argsort(bin_index, kind='stable')
+        bin_count = np.bincount(bin_index, minlength=bins)
+        filled = np.flatnonzero(bin_count)
+        starts = np.cumsum(bin_count)[filled] - bin_count[filled]
+        bin_lower = np.full((bins, 3), inf)
+        bin_upper = np.full((bins, 3), -inf)
+        bin_lower[filled] = np.minimum.reduceat(lower[sort], starts)
+        bin_upper[filled] = np.maximum.reduceat(upper[sort], starts)
+        left_count = np.cumsum(bin_count)[:-1]
+        right_count = count - left_count
+        left_area = half_area(np.minimum.accumulate(bin_lower), np.maximum.accumulate(bin_upper))[:-1]
+        right_area = half_area(np.minimum.accumulate(bin_lower[::-1])[::-1],
+                               np.maximum.accumulate(bin_upper[::-1])[::-1])[1:]
+        with np.errstate(invalid='ignore'):
+            cost = np.where((left_count > 0) & (right_count > 0), left_count * left_area + right_count * right_area,
+                            inf)
+        return bin_index <= int(np.argmin(cost))
+
+    def closest_hit(self, origin: tuple, direction: tuple, distance, t_max: float = inf) -> tuple:
+        # distance(primitive) -> расстояние до пересечения или inf
+        inverse = tuple(1 / d if d != 0 else inf for d in direction)
+        nodes, order = self.nodes, self.order
+        closest, closest_primitive = t_max, -1
+        stack = [0]
+        while stack:
+            lower, upper, left, first, count = nodes[stack.pop()]
+            if self.box_distance(lower, upper, origin, inverse) >= closest:
+                continue
+            if left < 0:
+                for primitive in order[first:first + count].tolist():
+                    t = distance(primitive)
+                    if t < closest:
+                        closest, closest_primitive = t, primitive
+                continue
+            near = self.box_distance(nodes[left][0], nodes[left][1], origin, inverse)
+            far = self.box_distance(nodes[left + 1][0], nodes[left + 1][1], origin, inverse)
+            if near <= far:
+                stack.append(left + 1)
+                stack.append(left)
+            else:
+                stack.append(left)
+                stack.append(left + 1)
+        return closest, closest_primitive
+
+    def any_hit(self, origin: tuple, direction: tuple, distance, t_max: float = inf) -> int:
+        # Первый найденный примитив ближе t_max или -1; порядок обхода не важен
+        inverse = tuple(1 / d if d != 0 else inf for d in direction)
+        nodes, order = self.nodes, self.order
+        stack = [0]
+        while stack:
+            lower, upper, left, first, count = nodes[stack.pop()]
+            if self.box_distance(lower, upper, origin, inverse) >= t_max:
+                continue
+            if left < 0:
+                for primitive in order[first:first + count].tolist():
+                    if distance(primitive) < t_max:
+                        return primitive
+                continue
+            stack.append(left + 1)
+            stack.append(left)
+        return -1
+
+    @staticmethod
+    def box_distance(lower: list, upper: list, origin: tuple, inverse: tuple) -> float:
+        t_near, t_far = 0.0, inf
+        for axis in range(3):
+            t0 = (lower[axis] - origin[axis]) * inverse[axis]
+            t1 = (upper[axis] - origin[axis]) * inverse[axis]
+            if t0 > t1:
+                t0, t1 = t1, t0
+            if t0 > t_near:
+                t_near = t0
+            if t1 < t_far:
+                t_far = t1
+        return t_near if t_near <= t_far else inf
+
+    def box_distances(self, nodes: np.ndarray, origins: np.ndarray, inverse: np.ndarray) -> np.ndarray:
+        with np.errstate(invalid='ignore'):
+            t0 = (self.lower[nodes].T - origins) * inverse
+            t1 = (self.upper[nodes].T - origins) * inverse
+        t_near = np.maximum(np.fmin(t0, t1).max(axis=0), 0)
+        t_far = np.fmax(t0, t1).min(axis=0)
+        return np.where(t_near <= t_far, t_near, inf)
+
+    def candidates(self, origins: np.ndarray, directions: np.ndarray, t: np.ndarray) -> tuple:
+        # Все пары (луч, примитив), у которых луч пересекает рамку листа ближе t. Обход в ширину:
+        # итераций столько, какова глубина дерева, зато примитивы потом проверяются одним вызовом
+        with np.errstate(divide='ignore'):
+            inverse = 1 / directions
+        rays = np.arange(t.size)
+        nodes = np.zeros(t.size, dtype=np.int64)
+        pair_rays, pair_primitives = [rays[:0]], [nodes[:0]]
+        while rays.size:
+            keep = self.box_distances(nodes, origins[:, rays], inverse[:, rays]) < t[rays]
+            rays, nodes = rays[keep], nodes[keep]
+            leaf = self.left[nodes] < 0
+            counts = self.count[nodes[leaf]]
+            starts = np.repeat(self.first[nodes[leaf]] - (np.cumsum(counts) - counts), counts)
+            pair_rays.append(np.repeat(rays[leaf], counts))
+            pair_primitives.append(self.order[starts + np.arange(counts.sum())])
+            rays = np.repeat(rays[~leaf], 2)
+            nodes = (self.left[nodes[~leaf], None] + np.array([0, 1])).ravel()
+        return np.concatenate(pair_rays), np.concatenate(pair_primitives)
+
+    def intersect(self, origins: np.ndarray, directions: np.ndarray, t: np.ndarray, primitives: np.ndarray,
+                  distance, any_hit: bool = False):
+        # У каждого луча свой стек, все лучи обходят дерево синхронно: за итерацию каждый снимает один узел.
+        # distance(origins, directions, primitives) -> расстояния по парам, t и primitives обновляются на месте
+        size = t.size
+        with np.errstate(divide='ignore'):
+            inverse = 1 / directions
+        stack = np.zeros((size, self.depth + 1), dtype=np.int64)
+        stack_t = np.zeros((size, self.depth + 1))
+        stack_t[:, 0] = self.box_distances(np.zeros(size, dtype=np.int64), origins, inverse)
+        pointer = (stack_t[:, 0] < t).astype(np.int64)
+        rays = np.flatnonzero(pointer)
+        leaf_size = int(self.count.max())
+        while rays.size:
+            pointer[rays] -= 1
+            nodes, t_near = stack[rays, pointer[rays]], stack_t[rays, pointer[rays]]
+            keep = t_near < t[rays]
+            if any_hit:
+                keep &= primitives[rays] < 0
+            rays, nodes = rays[keep], nodes[keep]
+
+            leaf = self.left[nodes] < 0
+            leaf_rays, leaf_nodes = rays[leaf], nodes[leaf]
+            for k in range(leaf_size):
+                has = k < self.count[leaf_nodes]
+                if not has.any():
+                    break
+                pair_rays = leaf_rays[has]
+                pair_primitives = self.order[self.first[leaf_nodes[has]] + k]
+                pair_t = distance(origins[:, pair_rays], directions[:, pair_rays], pair_primitives)
+                better = pair_t < t[pair_rays]
+                t[pair_rays[better]] = pair_t[better]
+                primitives[pair_rays[better]] = pair_primitives[better]
+
+            inner_rays, left = rays[~leaf], self.left[nodes[~leaf]]
+            t_left = self.box_distances(left, origins[:, inner_rays], inverse[:, inner_rays])
+            t_right = self.box_distances(left + 1, origins[:, inner_rays], inverse[:, inner_rays])
+            # Сначала кладём дальнего ребёнка, чтобы ближний снимался первым
+            left_first = t_left <= t_right
+            far, t_far = np.where(left_first, left + 1, left), np.where(left_first, t_right, t_left)
+            near, t_near = np.where(left_first, left, left + 1), np.where(left_first, t_left, t_right)
+            for child, t_child in ((far, t_far), (near, t_near)):
+                push = t_child < t[inner_rays]
+                push_rays = inner_rays[push]
+                stack[push_rays, pointer[push_rays]] = child[push]
+                stack_t[push_rays, pointer[push_rays]] = t_child[push]
+                pointer[push_rays] += 1
+
+            rays = np.flatnonzero(pointer)
+
+
+class ObjectBVH:
+    # Дерево над ограниченными объектами сцены; бесконечные плоскости проверяются отдельно
+    __slots__ = ('objects', 'planes', 'tree', 'last_occluder')
+
+    def __init__(self, objects: list, leaf_size: int = 4):
+        self.objects = [obj for obj in objects if hasattr(obj, 'bounds')]
+        self.planes = [obj for obj in objects if not hasattr(obj, 'bounds')]
+        self.tree = None
+        self.last_occluder = None
+        if self.objects:
+            bounds = [obj.bounds() for obj in self.objects]
+            lower = np.array([(low.x, low.y, low.z) for low, _ in bounds], dtype=np.float64)
+            upper = np.array([(high.x, high.y, high.z) for _, high in bounds], dtype=np.float64)
+            self.tree = BVH(lower, upper, leaf_size)
+
+    def __repr__(self) -> str:
+        return f"ObjectBVH(objects: {len(self.objects)}, planes: {len(self.planes)})"
+
+    def cast(self, ray) -> tuple:
+        closest, closest_object = inf, False
+        for plane in self.planes:
+            distance, hit_object = plane.hit(ray)
+            if distance < closest:
+                closest, closest_object = distance, hit_object
+        if self.tree is not None:
+            # hit() у сетки возвращает конкретный треугольник, запоминаем его для победителя
+            hit_objects = {}
+
+            def distance(index: int) -> float:
+                t, hit_objects[index] = self.objects[index].hit(ray)
+                return t
+
+            origin = (ray.origin.x, ray.origin.y, ray.origin.z)
+            direction = (ray.direction.x, ray.direction.y, ray.direction.z)
+            t, primitive = self.tree.closest_hit(origin, direction, distance, closest)
+            if primitive >= 0:
+                closest, closest_object = t, hit_objects[primitive]
+        if closest_object is False:
+            return False, False
+        return ray.origin.madd(ray.direction, closest), closest_object
+
+    def occluded(self, ray, t_max: float = inf) -> bool:
+        # Соседние пиксели обычно закрывает один и тот же объект: его проверяем первым.
+        # Дерево своё в каждом процессе, поэтому и кеш получается на воркер
+        last = self.last_occluder
+        if last is not None and last.distance(ray) < t_max:
+            return True
+        for plane in self.planes:
+            if plane is not last and plane.distance(ray) < t_max:
+                self.last_occluder = plane
+                return True
+        if self.tree is None:
+            return False
+        origin = (ray.origin.x, ray.origin.y, ray.origin.z)
+        direction = (ray.direction.x, ray.direction.y, ray.direction.z)
+        primitive = self.tree.any_hit(origin, direction, lambda index: self.objects[index].distance(ray), t_max)
+        if primitive < 0:
+            return False
+        self.last_occluder = self.objects[primitive]
+        return True
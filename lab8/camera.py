@@ -1,13 +1,17 @@
 from __future__ import annotations
 
-from random import uniform
-from math import tan, radians, sqrt
+from random import random
+from math import tan, radians, sqrt, cos, sin, pi
+
+import numpy as np
+
 from vector import Vector
 from ray import Ray
 
 
 class Camera:
-    __slots__ = ('position', 'screen_size', 'fov', 'focus_distance', 'aperture')
+    __slots__ = ('position', 'screen_size', 'fov', 'focus_distance', 'aperture', 'projection_key', 'projection',
+                 'table_key', 'table')
 
     def __init__(self, position: Vector, screen_size: Vector, fov: int | float = 60.0, focus_distance: float = 10.0,
                  aperture: float = 0.1):
@@ -16,23 +20,54 @@ class Camera:
         self.fov = fov
         self.focus_distance = focus_distance
         self.aperture = aperture
+        self.projection_key = self.table_key = None
+        self.projection = self.table = None
 
     def __repr__(self) -> str:
         return f"Camera(position: {self.position}, screen_size: {self.screen_size}, fov: {self.fov}, focus_distance: " \
                f"{self.focus_distance}, aperture: {self.aperture})"
 
-    def get_direction(self, x_y: Vector) -> Ray:
-        # Original direction calculation
-        xy = x_y - self.screen_size / 2
-        z = self.screen_size.y / tan(radians(self.fov) / 2)
-        direction = Vector(xy.x, xy.y, -z).normalize()
+    def __getstate__(self) -> tuple:
+        # Таблица направлений в воркеры не передаётся: каждый процесс строит её сам при первом обращении
+        return None, {name: getattr(self, name) for name in self.__slots__ if name not in ('table_key', 'table')}
+
+    def __setstate__(self, state: tuple):
+        for name, value in state[1].items():
+            setattr(self, name, value)
+        self.table_key = self.table = None
+
+    def get_projection(self) -> tuple:
+        # (половина ширины, половина высоты, расстояние до экрана) пересчитываются только при смене fov или размера
+        key = (self.fov, self.screen_size.x, self.screen_size.y)
+        if key != self.projection_key:
+            self.projection_key = key
+            self.projection = (self.screen_size.x / 2, self.screen_size.y / 2,
+                               self.screen_size.y / tan(radians(self.fov) / 2))
+        return self.projection
+
+    def get_table(self) -> np.ndarray:
+        # Единичные направления через центры пикселей float32 (3, h, w), для pinhole-камеры без тригонометрии
+        key = (self.get_projection(), self.position.x, self.position.y, self.position.z)
+        if key != self.table_key:
+            half_width, half_height, z = self.projection
+            ys, xs = np.mgrid[0:int(self.screen_size.y), 0:int(self.screen_size.x)]
+            table = np.stack((xs - half_width, ys - half_height, np.full(xs.shape, -z)))
+            self.table = (table / np.sqrt((table * table).sum(axis=0))).astype(np.float32)
+            self.table_key = key
+        return self.table
+
+    def get_direction(self, x_y: Vector, lens: float | None = None) -> Ray:
+        half_width, half_height, z = self.get_projection()
+        direction = Vector(x_y.x - half_width, x_y.y - half_height, -z).normalize()
 
         # Random point within aperture
         if self.aperture > 0:
-            rd = Vector(uniform(-1, 1), uniform(-1, 1), 0).normalize() * (self.aperture / 2)
-            focal_point = self.position + direction * self.focus_distance
-            direction = (focal_point - (self.position + rd)).normalize()
-            origin = self.position + rd
+            # lens в [0, 1) - положение точки на краю апертуры, по умолчанию случайное
+            angle = (random() if lens is None else lens) * 2 * pi
+            rd = Vector(cos(angle), sin(angle), 0).scale(self.aperture / 2)
+            focal_point = self.position.madd(direction, self.focus_distance)
+            origin = self.position.add(rd)
+            direction = focal_point.sub(origin).normalize()
         else:
             origin = self.position
 
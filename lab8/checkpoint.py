@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import os
+from time import perf_counter
+
+import numpy as np
+
+from tiles import TileRenderer, make_tiles
+
+magic = 0x38424C54504B4843  # 'CHKPTLB8'
+header_size = 8
+
+
+class Checkpoint:
+    # Файл: заголовок uint64 [magic, width, height, tile_size, tiles, seed_lo, seed_hi, passes],
+    # флаги готовых тайлов текущего прохода, сумма цветов float64 (h, w, 3) и число сэмплов int32 (h, w).
+    # Всё отображено в память: тайл пишется прямо в файл, flush только сбрасывает страницы на диск
+    __slots__ = ('path', 'width', 'height', 'tile_size', 'tiles', 'memory', 'header', 'done', 'accumulation',
+                 'counts', 'flush_interval', 'flushed')
+
+    def __init__(self, path: str, width: int, height: int, tile_size: int = 32, resume: bool = False,
+                 flush_interval: float = 10.0):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.tiles = make_tiles(width, height, tile_size)
+        self.flush_interval = flush_interval
+        done_size = (len(self.tiles) + 7) // 8 * 8
+        size = header_size * 8 + done_size + width * height * (3 * 8 + 4)
+
+        resume = resume and os.path.exists(path)
+        expected = [magic, width, height, tile_size, len(self.tiles)]
+        if resume:
+            # Заголовок читается до отображения: файл другого размера кадра короче или длиннее size
+            found = np.fromfile(path, dtype=np.uint64, count=header_size).tolist()
+            if len(found) < header_size or found[0] != magic:
+                raise ValueError(f"{path} is not a checkpoint file")
+            if found[:5] != expected:
+                found = found[1:4]
+                raise ValueError(f"Checkpoint {path} is for {found[0]}x{found[1]} with tile size {found[2]}, "
+                                 f"not {width}x{height} with tile size {tile_size}")
+            if os.path.getsize(path) != size:
+                raise ValueError(f"Checkpoint {path} has {os.path.getsize(path)} bytes, expected {size}")
+        self.memory = np.memmap(path, dtype=np.uint8, mode='r+' if resume else 'w+', shape=(size,))
+        self.header = np.ndarray((header_size,), dtype=np.uint64, buffer=self.memory)
+        offset = header_size * 8
+        self.done = np.ndarray((len(self.tiles),), dtype=np.uint8, buffer=self.memory, offset=offset)
+        offset += done_size
+        self.accumulation = np.ndarray((height, width, 3), dtype=np.float64, buffer=self.memory, offset=offset)
+        offset += width * height * 3 * 8
+        self.counts = np.ndarray((height, width), dtype=np.int32, buffer=self.memory, offset=offset)
+
+        if not resume:
+            self.header[:5] = expected
+        self.flushed = perf_counter()
+
+    def __repr__(self) -> str:
+        return f"Checkpoint(path: {self.path}, size: {self.width}x{self.height}, passes: {self.passes}, " \
+               f"done: {int(self.done.sum())}/{len(self.tiles)})"
+
+    @property
+    def seed(self) -> int:
+        return int(self.header[5]) | int(self.header[6]) << 64
+
+    @seed.setter
+    def seed(self, value: int):
+        self.header[5], self.header[6] = value & (1 << 64) - 1, value >> 64 & (1 << 64) - 1
+
+    @property
+    def passes(self) -> int:
+        return int(self.header[7])
+
+    def image(self) -> np.ndarray:
+        return (self.accumulation / np.maximum(self.counts, 1)[..., None]).astype(np.float32)
+
+    def add_tile(self, index: int, tile: tuple, colors: np.ndarray, counts: np.ndarray):
+        x0, y0, x1, y1 = tile
+        self.accumulation[y0:y1, x0:x1] += colors * counts[..., None]
+        self.counts[y0:y1, x0:x1] += counts
+        self.done[index] = 1
+        if perf_counter() - self.flushed >= self.flush_interval:
+            self.flush()
+
+    def finish_pass(self):
+        self.done[:] = 0
+        self.header[7] += 1
+        self.flush()
+
+    def flush(self):
+        self.memory.flush()
+        self.flushed = perf_counter()
+
+    def render(self, tile_renderer: TileRenderer, samples: int, passes: int = 1, seed: int | None = None,
+               time_budget: float | None = None):
+        # passes проходов по samples сэмплов; готовые проходы и тайлы после возобновления не пересчитываются.
+        # Сэмплы тайла зависят только от (seed, проход, номер тайла), поэтому seed хранится в файле
+        if tile_renderer.tile_size != self.tile_size:
+            raise ValueError(f"Tile size {tile_renderer.tile_size} does not match the checkpoint ({self.tile_size})")
+        if self.passes == 0 and not self.done.any():
+            self.seed = np.random.SeedSequence().entropy if seed is None else seed
+        elif seed is not None and seed != self.seed:
+            # С другим seed продолжение смешало бы в одном кадре сэмплы двух разных последовательностей
+            raise ValueError(f"Checkpoint {self.path} was started with seed {self.seed}, not {seed}")
+        indices = {tile: index for index, tile in enumerate(self.tiles)}
+        framebuffer = tile_renderer.framebuffer
+        start = perf_counter()
+        while self.passes < passes and (time_budget is None or perf_counter() - start < time_budget):
+            for tile in tile_renderer.render(samples, self.seed, self.passes, self.done.astype(bool)):
+                x0, y0, x1, y1 = tile
+                self.add_tile(indices[tile], tile, framebuffer.array[y0:y1, x0:x1], framebuffer.counts[y0:y1, x0:x1])
+                yield tile
+            if not self.done.all():
+                # Рендер отменён посреди прохода: оставшиеся тайлы дорендерятся после возобновления
+                return
+            self.finish_pass()
+
+    def close(self):
+        if self.memory is not None:
+            self.memory.flush()
+        self.memory = self.header = self.done = self.accumulation = self.counts = None
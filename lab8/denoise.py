@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import numpy as np
+
+# Ядро B3-сплайна для à-trous (Dammertz и др. 2010): на итерации i между отсчётами 2^i - 1 пропусков
+kernel = (1 / 16, 1 / 4, 3 / 8, 1 / 4, 1 / 16)
+epsilon = np.float32(1e-4)
+
+
+def luminance(image: np.ndarray) -> np.ndarray:
+    return 0.2126 * image[0] + 0.7152 * image[1] + 0.0722 * image[2]
+
+
+def part(array: np.ndarray, axis: int, start: int | None, stop: int | None) -> np.ndarray:
+    # Срез вдоль оси, считаемой с конца: -2 - строки, -1 - столбцы
+    window = [slice(None)] * array.ndim
+    window[axis] = slice(start, stop)
+    return array[tuple(window)]
+
+
+def blur(array: np.ndarray) -> np.ndarray:
+    # Гаусс 3x3 по последним двум осям, края продолжаются повтором
+    for axis in (-2, -1):
+        before = np.concatenate((part(array, axis, None, 1), part(array, axis, None, -1)), axis)
+        after = np.concatenate((part(array, axis, 1, None), part(array, axis, -1, None)), axis)
+        array = 0.5 * array + 0.25 * (before + after)
+    return array
+
+
+def estimate_variance(image: np.ndarray) -> np.ndarray:
+    # Без дисперсии сэмплов (1 сэмпл, адаптивный режим) - дисперсия яркости по окрестности 3x3
+    value = luminance(image)
+    return np.maximum(blur(value * value) - blur(value) ** 2, 0)
+
+
+def filter_axis(image: np.ndarray, variance: np.ndarray, features: np.ndarray, step: int, axis: int,
+                sigma_luminance: float) -> tuple:
+    # Один проход ядра вдоль оси (SVGF, Schied и др. 2017): вес соседа падает с разницей AOV и с разницей
+    # яркости относительно её шума, поэтому сошедшиеся детали сохраняются, а шумные области сглаживаются.
+    # Вес пары пикселей симметричен и считается один раз на обе стороны; за краем кадра соседей нет.
+    # Дисперсия фильтруется квадратами весов, чтобы на следующей итерации порог соответствовал остатку шума
+    value = luminance(image)
+    deviation = np.float32(sigma_luminance / 2) * np.sqrt(blur(variance))
+    center = np.float32(kernel[2])
+    result, weights, filtered = image * center, np.full(value.shape, center), variance * (center * center)
+    for tap in (3, 4):
+        offset = (tap - 2) * step
+        if offset >= value.shape[axis]:
+            break
+        near, far = (None, -offset), (offset, None)
+        difference = part(features, axis, *far) - part(features, axis, *near)
+        scale = 1 / (part(deviation, axis, *near) + part(deviation, axis, *far) + epsilon)
+        weight = np.exp(-np.einsum('chw,chw->hw', difference, difference)
+                        - np.abs(part(value, axis, *far) - part(value, axis, *near)) * scale)
+        weight *= np.float32(kernel[tap])
+        square = weight * weight
+        part(result, axis, *near)[...] += part(image, axis, *far) * weight
+        part(result, axis, *far)[...] += part(image, axis, *near) * weight
+        part(weights, axis, *near)[...] += weight
+        part(weights, axis, *far)[...] += weight
+        part(filtered, axis, *near)[...] += part(variance, axis, *far) * square
+        part(filtered, axis, *far)[...] += part(variance, axis, *near) * square
+    return result / weights, filtered / (weights * weights)
+
+
+def denoise(color: np.ndarray, albedo: np.ndarray, normals: np.ndarray, depth: np.ndarray,
+            variance: np.ndarray | None = None, iterations: int = 4, sigma_luminance: float = 4.0,
+            sigma_normal: float = 0.3, sigma_albedo: float = 0.1, sigma_depth: float = 0.2) -> np.ndarray:
+    # Edge-aware à-trous по цвету (h, w, 3) с AOV первого попадания и дисперсией средней яркости пикселя (h, w).
+    # Каждая итерация - два разделимых прохода по осям. Расстояние сравнивается обратным, в долях медианного:
+    # небо (0) и дальние попадания у горизонта почти совпадают, как и на изображении
+    hit = depth > 0
+    near = float(np.median(depth[hit])) if hit.any() else 1.0
+    inverse = np.where(hit, near / np.where(hit, depth, 1), 0)
+    features = np.concatenate((normals.transpose(2, 0, 1) / np.float32(sigma_normal),
+                               albedo.transpose(2, 0, 1) / np.float32(sigma_albedo),
+                               inverse[None] / np.float32(sigma_depth))).astype(np.float32)
+    # AOV из нескольких сэмплов шумят там же, где цвет (глубина резкости, горизонт): сглаживание 3x3 убирает шум,
+    # из-за которого края не дают соседям смешиваться
+    features = blur(features)
+    image = np.ascontiguousarray(color.transpose(2, 0, 1), dtype=np.float32)
+    variance = estimate_variance(image) if variance is None else variance
+    variance = np.asarray(variance, dtype=np.float32)
+    for iteration in range(iterations):
+        for axis in (-2, -1):
+            image, variance = filter_axis(image, variance, features, 1 << iteration, axis, sigma_luminance)
+    return image.transpose(1, 2, 0)
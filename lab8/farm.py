@@ -0,0 +1,336 @@
+from __future__ import annotations
+
+import pickle
+import socket
+import struct
+import sys
+import zlib
+from argparse import ArgumentParser
+from collections import deque
+from io import BytesIO
+from multiprocessing import get_context
+from queue import Empty, Queue
+from socketserver import BaseRequestHandler, ThreadingTCPServer
+from threading import Condition, Thread
+from time import perf_counter, sleep
+
+import numpy as np
+
+from batch import BatchRenderer
+from adaptive import AdaptiveSampler
+from tiles import SharedFramebuffer, make_tiles, render_colors
+from skybox import Skybox
+
+# Рендер-ферма: координатор раздаёт тайлы по TCP, воркеры на других машинах (или локальные процессы)
+# рендерят их и возвращают сжатые float32-буферы. Сообщение - тип uint8 и длина тела uint64, затем тело
+header = struct.Struct('!BQ')
+SCENE, JOB, RESULT, DONE = 1, 2, 3, 4
+# Задание: номер, x0, y0, x1, y1, сэмплов, проход, seed младшие и старшие 64 бита
+job_format = struct.Struct('!Q4IIIQQ')
+# Результат: номер задания и число лучей, затем сжатый тайл
+result_format = struct.Struct('!QQ')
+# Предел тела сообщения по умолчанию: длина приходит от другой стороны, и без предела её хватит на любой malloc
+max_message = 1 << 30
+
+
+def send_message(connection: socket.socket, kind: int, payload: bytes = b''):
+    connection.sendall(header.pack(kind, len(payload)))
+    connection.sendall(payload)
+
+
+def receive_exact(connection: socket.socket, size: int) -> bytearray:
+    data = bytearray(size)
+    view = memoryview(data)
+    while view:
+        received = connection.recv_into(view)
+        if not received:
+            raise ConnectionError("Connection closed")
+        view = view[received:]
+    return data
+
+
+def receive_message(connection: socket.socket, limit: int = max_message) -> tuple:
+    kind, size = header.unpack(receive_exact(connection, header.size))
+    if size > limit:
+        raise ValueError(f"Message of {size} bytes exceeds the {limit} byte limit")
+    return kind, receive_exact(connection, size)
+
+
+def tile_bytes(pixels: int) -> int:
+    # Размер несжатого тайла: float32 цвет и int32 число сэмплов
+    return pixels * 4 * 4
+
+
+def pack_tile(colors: np.ndarray, counts: np.ndarray) -> bytes:
+    # Быстрое сжатие: на тайлах default-сцены zlib 1 уменьшает буфер в 4-5 раз
+    return zlib.compress(colors.astype('<f4').tobytes() + counts.astype('<i4').tobytes(), 1)
+
+
+def unpack_tile(data: bytes, tile: tuple) -> tuple:
+    x0, y0, x1, y1 = tile
+    pixels = (x1 - x0) * (y1 - y0)
+    # Распаковываем не больше ожидаемого: иначе маленькое сообщение может развернуться в гигабайты
+    decompressor = zlib.decompressobj()
+    raw = decompressor.decompress(data, tile_bytes(pixels))
+    if len(raw) != tile_bytes(pixels) or not decompressor.eof or decompressor.unconsumed_tail \
+            or decompressor.unused_data:
+        raise ValueError(f"Tile {tile} does not unpack to {tile_bytes(pixels)} bytes")
+    colors = np.frombuffer(raw, dtype='<f4', count=pixels * 3).reshape(y1 - y0, x1 - x0, 3)
+    counts = np.frombuffer(raw, dtype='<i4', offset=pixels * 12).reshape(y1 - y0, x1 - x0)
+    return colors, counts
+
+
+class ScenePickler(pickle.Pickler):
+    # Воркер на другой машине не видит файлов координатора: панорама уходит в сцене целиком,
+    # а не путём, как в локальные процессы пула
+    def reducer_override(self, obj):
+        return obj.portable() if isinstance(obj, Skybox) else NotImplemented
+
+
+def dump_scene(renderer: BatchRenderer, sampler: AdaptiveSampler | None) -> bytes:
+    buffer = BytesIO()
+    ScenePickler(buffer, pickle.HIGHEST_PROTOCOL).dump((renderer, sampler))
+    return buffer.getvalue()
+
+
+def run_worker(host: str, port: int, retry: float = 30.0):
+    # Сцена приходит pickle от координатора, поэтому подключаться стоит только к своему координатору
+    start = perf_counter()
+    while True:
+        try:
+            connection = socket.create_connection((host, port))
+            break
+        except OSError:
+            if perf_counter() - start > retry:
+                raise
+            sleep(0.5)
+    with connection:
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        kind, payload = receive_message(connection)
+        if kind != SCENE:
+            raise ConnectionError(f"Expected a scene, got message {kind}")
+        renderer, sampler = pickle.loads(zlib.decompress(payload))
+        while True:
+            kind, payload = receive_message(connection)
+            if kind == DONE:
+                return
+            job, x0, y0, x1, y1, samples, stream, seed_lo, seed_hi = job_format.unpack(payload)
+            rays = renderer.rays
+            colors, counts = render_colors(renderer, sampler, (x0, y0, x1, y1), samples, seed_lo | seed_hi << 64,
+                                           stream)
+            send_message(connection, RESULT,
+                         result_format.pack(job, renderer.rays - rays) + pack_tile(colors, counts))
+
+
+class FarmServer(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class WorkerHandler(BaseRequestHandler):
+    def handle(self):
+        self.server.coordinator.serve(self.request)
+
+
+class Coordinator:
+    # Замена TileRenderer, раздающая тайлы по сети: подходит ProgressiveRenderer и Checkpoint.
+    # Каждое соединение обслуживает свой поток; на воркере до prefetch заданий, чтобы он не ждал сети.
+    # Тайлы отключившегося воркера возвращаются в очередь, а задание, не сданное за lease секунд,
+    # выдаётся повторно, когда очередь пуста; засчитывается первый результат. Если ни одного воркера
+    # нет дольше worker_timeout секунд, а тайлы остались, render() завершается ошибкой
+    __slots__ = ('renderer', 'width', 'height', 'tile_size', 'sampler', 'framebuffer', 'rays', 'stats', 'lease',
+                 'prefetch', 'worker_timeout', 'result_limit', 'scene', 'condition', 'pending', 'running', 'finished',
+                 'results', 'next_job', 'closed', 'connections', 'idle_since', 'server', 'thread', 'processes')
+
+    def __init__(self, renderer: BatchRenderer, width: int, height: int, tile_size: int = 32,
+                 sampler: AdaptiveSampler | None = None, host: str = '0.0.0.0', port: int = 0,
+                 local_workers: int = 0, lease: float = 120.0, prefetch: int = 2, worker_timeout: float = 300.0):
+        self.renderer = renderer
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.sampler = sampler
+        self.framebuffer = SharedFramebuffer(width, height)
+        self.rays = 0
+        # Статистика остаётся на воркерах
+        self.stats = None
+        self.lease = lease
+        self.prefetch = prefetch
+        self.worker_timeout = worker_timeout
+        # Самый большой допустимый результат: сжатый тайл не длиннее несжатого с запасом zlib на заголовки
+        raw = tile_bytes(tile_size * tile_size)
+        self.result_limit = result_format.size + raw + raw // 1000 + 1024
+        # Сцена сериализуется один раз и отдаётся каждому подключившемуся воркеру
+        self.scene = zlib.compress(dump_scene(renderer, sampler), 1)
+        self.condition = Condition()
+        self.pending = deque()
+        # Номер задания -> (задание, срок сдачи)
+        self.running = {}
+        self.finished = set()
+        self.results = Queue()
+        self.next_job = 0
+        self.closed = False
+        self.connections = 0
+        self.idle_since = perf_counter()
+        self.server = FarmServer((host, port), WorkerHandler)
+        self.server.coordinator = self
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        # Локальные воркеры вместо удалённых машин
+        host, port = self.address
+        context = get_context('spawn')
+        self.processes = [context.Process(target=run_worker, args=('127.0.0.1' if host == '0.0.0.0' else host, port))
+                          for _ in range(local_workers)]
+        for process in self.processes:
+            process.start()
+
+    def __repr__(self) -> str:
+        return f"Coordinator(address: {self.address}, size: {self.width}x{self.height}, tile_size: {self.tile_size})"
+
+    @property
+    def address(self) -> tuple:
+        return self.server.server_address[:2]
+
+    def render(self, samples: int, seed: int | None = None, stream: int = 0, done: np.ndarray | None = None):
+        # Тот же интерфейс, что у TileRenderer.render: тайлы отдаются по мере того, как их сдают воркеры
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        tiles = [(index, tile) for index, tile in enumerate(make_tiles(self.width, self.height, self.tile_size))
+                 if done is None or not done[index]]
+        with self.condition:
+            for index, tile in tiles:
+                self.pending.append((self.next_job, tile, samples, seed, stream))
+                self.next_job += 1
+            self.condition.notify_all()
+        for _ in tiles:
+            yield self.next_result()
+
+    def next_result(self) -> tuple:
+        while True:
+            try:
+                return self.results.get(timeout=1.0)
+            except Empty:
+                with self.condition:
+                    if self.connections == 0 and perf_counter() - self.idle_since > self.worker_timeout:
+                        raise ConnectionError(f"No render farm workers for {self.worker_timeout:.0f} s, "
+                                              f"{len(self.pending) + len(self.running)} tiles left")
+
+    def take(self, assigned: dict):
+        # Под self.condition: следующее задание из очереди или просроченное чужое
+        while self.pending:
+            job = self.pending.popleft()
+            if job[0] not in self.finished:
+                self.running[job[0]] = (job, perf_counter() + self.lease)
+                return job
+        now = perf_counter()
+        for number, (job, deadline) in self.running.items():
+            if deadline < now and number not in assigned:
+                self.running[number] = (job, now + self.lease)
+                return job
+        return None
+
+    def serve(self, connection: socket.socket):
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        assigned = {}
+        with self.condition:
+            self.connections += 1
+        try:
+            send_message(connection, SCENE, self.scene)
+            while True:
+                with self.condition:
+                    jobs = []
+                    while len(assigned) + len(jobs) < self.prefetch:
+                        job = self.take(assigned)
+                        if job is None:
+                            break
+                        jobs.append(job)
+                    if not assigned and not jobs:
+                        if self.closed:
+                            send_message(connection, DONE)
+                            return
+                        self.condition.wait(1.0)
+                        continue
+                for job in jobs:
+                    number, (x0, y0, x1, y1), samples, seed, stream = job
+                    assigned[number] = job
+                    send_message(connection, JOB, job_format.pack(number, x0, y0, x1, y1, samples, stream,
+                                                                  seed & (1 << 64) - 1, seed >> 64 & (1 << 64) - 1))
+                kind, payload = receive_message(connection, self.result_limit)
+                if kind != RESULT:
+                    raise ValueError(f"Expected a result, got message {kind}")
+                number, rays = result_format.unpack_from(payload)
+                job = assigned.pop(number)
+                colors, counts = unpack_tile(bytes(payload[result_format.size:]), job[1])
+                self.finish(job, colors, counts, rays)
+        except (OSError, ValueError, KeyError, zlib.error, struct.error):
+            # Воркер отключился или прислал мусор: его задания вернутся в очередь
+            pass
+        finally:
+            with self.condition:
+                self.connections -= 1
+                if self.connections == 0:
+                    self.idle_since = perf_counter()
+                for job in assigned.values():
+                    if job[0] not in self.finished:
+                        self.running.pop(job[0], None)
+                        self.pending.appendleft(job)
+                self.condition.notify_all()
+            connection.close()
+
+    def finish(self, job: tuple, colors: np.ndarray, counts: np.ndarray, rays: int):
+        with self.condition:
+            if job[0] in self.finished:
+                return
+            self.finished.add(job[0])
+            self.running.pop(job[0], None)
+            self.rays += rays
+        x0, y0, x1, y1 = tile = job[1]
+        self.framebuffer.array[y0:y1, x0:x1] = colors
+        self.framebuffer.counts[y0:y1, x0:x1] = counts
+        self.results.put(tile)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.pending.clear()
+            self.running.clear()
+            self.condition.notify_all()
+        for process in self.processes:
+            process.join(10)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.server.shutdown()
+        self.server.server_close()
+        self.framebuffer.close()
+
+
+def parse_args(argv: list | None = None):
+    parser = ArgumentParser(description="Render farm worker: pull lab8 tiles from a coordinator started with "
+                                        "render.py --listen")
+    parser.add_argument('address', help="coordinator HOST:PORT")
+    parser.add_argument('--processes', type=int, default=1, help="worker processes on this machine")
+    parser.add_argument('--retry', type=float, default=30.0, help="seconds to wait for the coordinator")
+    args = parser.parse_args(argv)
+    host, _, port = args.address.rpartition(':')
+    if not host or not port.isdigit():
+        parser.error(f"expected HOST:PORT, got {args.address!r}")
+    return args, host, int(port)
+
+
+def main(argv: list | None = None):
+    args, host, port = parse_args(argv)
+    if args.processes == 1:
+        run_worker(host, port, args.retry)
+        return
+    context = get_context('spawn')
+    processes = [context.Process(target=run_worker, args=(host, port, args.retry)) for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    sys.exit(max(process.exitcode for process in processes))
+
+
+if __name__ == '__main__':
+    main()
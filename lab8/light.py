@@ -1,8 +1,16 @@
 from __future__ import annotations
 
+from bisect import bisect_right
+
+import numpy as np
+
 from vector import Vector
 
 
+def luminance(color: Vector) -> float:
+    return 0.2126 * color.x + 0.7152 * color.y + 0.0722 * color.z
+
+
 class Light:
     __slots__ = ('direction', 'strength', 'diffuse_color', 'specular_color', 'ambient_color')
 
@@ -16,3 +24,56 @@ class Light:
 
     def __repr__(self) -> str:
         return f"Light(direction: {self.direction})"
+
+    def power(self) -> float:
+        # Оценка вклада для выбора источника: одинакова для всех точек сцены
+        return self.strength * (luminance(self.diffuse_color) + luminance(self.ambient_color))
+
+
+class PointLight:
+    # Сила задана на единичном расстоянии и убывает как 1 / d^2
+    __slots__ = ('position', 'strength', 'diffuse_color', 'specular_color', 'ambient_color')
+
+    def __init__(self, position: Vector, strength: float, diffuse_color: Vector, specular_color: Vector,
+                 ambient_color: Vector):
+        self.position = position
+        self.strength = strength
+        self.diffuse_color = diffuse_color
+        self.specular_color = specular_color
+        self.ambient_color = ambient_color
+
+    def __repr__(self) -> str:
+        return f"PointLight(position: {self.position}, strength: {self.strength})"
+
+    def power(self) -> float:
+        return self.strength * (luminance(self.diffuse_color) + luminance(self.ambient_color))
+
+
+class LightSet:
+    # Источники выбираются с вероятностью, пропорциональной power(): номер ищется бинарным поиском по CDF,
+    # поэтому цена выбора почти не растёт с числом источников
+    __slots__ = ('lights', 'pdf', 'cdf', 'cdf_list')
+
+    def __init__(self, lights: list):
+        if not lights:
+            raise ValueError("A scene needs at least one light")
+        self.lights = lights
+        power = np.array([max(light.power(), 0.0) for light in lights], dtype=np.float64)
+        if power.sum() <= 0:
+            power = np.ones(len(lights))
+        self.pdf = power / power.sum()
+        self.cdf = np.cumsum(self.pdf)
+        self.cdf[-1] = 1.0
+        self.cdf_list = self.cdf.tolist()
+
+    def __repr__(self) -> str:
+        return f"LightSet(lights: {len(self.lights)})"
+
+    def __len__(self) -> int:
+        return len(self.lights)
+
+    def sample(self, u: np.ndarray) -> np.ndarray:
+        return np.minimum(np.searchsorted(self.cdf, u, side='right'), len(self.lights) - 1)
+
+    def sample_int(self, u: float) -> int:
+        return min(bisect_right(self.cdf_list, u), len(self.lights) - 1)
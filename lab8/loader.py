@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import json
+import os
+
+import numpy as np
+
+from objects import Sphere, SphereSet, InfinityChessBoard, Material
+from mesh import Mesh, MeshInstances, UP_AXES, load_obj
+from camera import Camera
+from skybox import Skybox
+from light import Light, PointLight
+from vector import Vector
+from sequences import make_sequence
+
+# Двоичный файл набора сфер: заголовок uint64 [magic, n], центры float64 (3, n), радиусы float64 (n,),
+# номера материалов int32 (n,). Столбцы отображаются в память как есть, без разбора и конструкторов
+magic = 0x384C544553485053  # 'SPHSETL8'
+header_size = 2
+
+
+def save_spheres(path: str, centers: np.ndarray, radii: np.ndarray, material_indices: np.ndarray):
+    count = radii.size
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as file:
+        file.write(np.array([magic, count], dtype=np.uint64).tobytes())
+        file.write(np.ascontiguousarray(centers, dtype=np.float64).reshape(3, count).tobytes())
+        file.write(np.ascontiguousarray(radii, dtype=np.float64).tobytes())
+        file.write(np.ascontiguousarray(material_indices, dtype=np.int32).tobytes())
+    os.replace(temporary, path)
+
+
+def load_spheres(path: str, materials: list) -> SphereSet:
+    memory = np.memmap(path, dtype=np.uint8, mode='r')
+    header = np.ndarray((header_size,), dtype=np.uint64, buffer=memory)
+    if int(header[0]) != magic:
+        raise ValueError(f"{path} is not a sphere set file")
+    count = int(header[1])
+    if memory.size != header_size * 8 + count * (4 * 8 + 4):
+        raise ValueError(f"{path} is truncated: expected {count} spheres")
+    offset = header_size * 8
+    centers = np.ndarray((3, count), dtype=np.float64, buffer=memory, offset=offset)
+    offset += count * 3 * 8
+    radii = np.ndarray((count,), dtype=np.float64, buffer=memory, offset=offset)
+    offset += count * 8
+    material_indices = np.ndarray((count,), dtype=np.int32, buffer=memory, offset=offset)
+    if count and int(material_indices.max()) >= len(materials):
+        raise ValueError(f"{path} uses material {int(material_indices.max())}, but only {len(materials)} are given")
+    return SphereSet(centers, radii, material_indices, materials)
+
+
+def vector(values: list) -> Vector:
+    return Vector(*(float(value) for value in values))
+
+
+class Scene:
+    # То же, что модуль scene.py, но собранное из описания: render.py принимает и то, и другое
+    __slots__ = ('path', 'screen_size', 'shadow_bias', 'max_reflections', 'min_throughput', 'roulette_depth',
+                 'samples_per_pixel', 'sequence', 'light_samples', 'camera', 'skybox', 'lights', 'materials',
+                 'prototypes', 'objects', 'meshes')
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path) as file:
+            description = json.load(file)
+        self.screen_size = vector(description.get('screen_size', (1440, 850)))
+        self.shadow_bias = description.get('shadow_bias', 0.0001)
+        self.max_reflections = description.get('max_reflections', 6)
+        self.min_throughput = description.get('min_throughput', 0.01)
+        self.roulette_depth = description.get('roulette_depth', 2)
+        self.samples_per_pixel = description.get('samples_per_pixel', 10)
+        self.sequence = make_sequence(description.get('sequence', 'sobol'), self.samples_per_pixel)
+        self.light_samples = description.get('light_samples', 1)
+
+        camera = description.get('camera', {})
+        self.camera = Camera(vector(camera.get('position', (0, 0, 5))), self.screen_size, camera.get('fov', 60),
+                             camera.get('focus_distance', 10.0), camera.get('aperture', 0.1))
+        self.skybox = Skybox(self.resolve(description.get('skybox', 'skybox.png')))
+        self.lights = [self.make_light(value) for value in description.get('lights', [description.get('light', {})])]
+
+        self.materials = {name: self.make_material(value) for name, value in description.get('materials', {}).items()}
+        # OBJ каждого файла разбирается один раз, сколько бы экземпляров на него ни ссылалось
+        self.meshes = {}
+        self.prototypes = {name: [obj for value in values for obj in self.make_objects(value)]
+                           for name, values in description.get('prototypes', {}).items()}
+        self.objects = [obj for value in description.get('objects', []) for obj in self.make_objects(value)]
+
+    def __repr__(self) -> str:
+        return f"Scene(path: {self.path}, objects: {len(self.objects)}, prototypes: {len(self.prototypes)})"
+
+    def resolve(self, path: str) -> str:
+        # Пути в описании считаются от папки самого файла
+        return os.path.join(os.path.dirname(self.path), path)
+
+    def make_light(self, value: dict):
+        colors = (vector(value.get('diffuse', (1, 1, 1))), vector(value.get('specular', (1, 1, 1))),
+                  vector(value.get('ambient', (0.2, 0.2, 0.2))))
+        if value.get('type', 'directional') == 'point':
+            return PointLight(vector(value['position']), value.get('strength', 1), *colors)
+        return Light(vector(value.get('direction', (-1, 1, -1))), value.get('strength', 1), *colors)
+
+    def make_material(self, value) -> Material:
+        if isinstance(value, str):
+            if value not in self.materials:
+                raise ValueError(f"Unknown material {value!r} in {self.path}")
+            return self.materials[value]
+        return Material(vector(value['diffuse']), vector(value.get('specular', (1, 1, 1))),
+                        vector(value.get('ambient', (0.1, 0.1, 0.1))), value.get('shininess', 32),
+                        value.get('reflectivity', 0.5))
+
+    def make_array(self, value, dtype) -> np.ndarray:
+        # Большие столбцы можно вынести в .npy рядом с описанием, они тоже отображаются в память
+        if isinstance(value, str):
+            return np.load(self.resolve(value), mmap_mode='r')
+        return np.array(value, dtype=dtype)
+
+    def make_objects(self, value: dict) -> list:
+        kind = value.get('type')
+        if kind == 'sphere':
+            material = self.make_material(value['material'])
+            return [Sphere(vector(value['center']), value['radius'], material.diffuse_color, material.specular_color,
+                           material.ambient_color, material.shininess, material.reflectivity)]
+        if kind == 'spheres':
+            materials = [self.make_material(material) for material in value['materials']]
+            if 'file' in value:
+                return [load_spheres(self.resolve(value['file']), materials)]
+            centers = self.make_array(value['centers'], np.float64).reshape(-1, 3).T
+            radii = self.make_array(value['radii'], np.float64)
+            material_indices = self.make_array(value.get('material_indices', np.zeros(radii.size)), np.int32)
+            return [SphereSet(centers, radii, material_indices, materials)]
+        if kind == 'plane':
+            return [InfinityChessBoard(value.get('y', 2), vector(value.get('color1', (0, 0, 0))),
+                                       vector(value.get('color2', (1, 1, 1))))]
+        if kind == 'mesh':
+            return [self.make_mesh(value)]
+        if kind == 'instances':
+            return self.make_instances(value)
+        raise ValueError(f"Unknown object type {kind!r} in {self.path}")
+
+    def make_mesh(self, value: dict) -> Mesh:
+        path = self.resolve(value['path'])
+        if path not in self.meshes:
+            self.meshes[path] = load_obj(path)
+        vertices, indices = self.meshes[path]
+        vertices = vertices @ (UP_AXES[value.get('up', 'z')].T * value.get('scale', 1)) + \
+            np.array(value.get('position', (0, 0, 0)))
+        material = self.make_material(value['material'])
+        return Mesh(vertices, indices, material.diffuse_color, material.specular_color, material.ambient_color,
+                    material.shininess, material.reflectivity)
+
+    def make_instances(self, value: dict) -> list:
+        # Копии прототипа со сдвигом positions (m, 3) и масштабом scales (m,). Все сферы прототипа
+        # размножаются одним broadcast в общий набор, сетка остаётся одна на все копии со своими сдвигом и масштабом
+        name = value['prototype']
+        if name not in self.prototypes:
+            raise ValueError(f"Unknown prototype {name!r} in {self.path}")
+        positions = self.make_array(value['positions'], np.float64).reshape(-1, 3)
+        scales = self.make_array(value.get('scales', np.ones(len(positions))), np.float64).reshape(-1)
+        if scales.size != len(positions):
+            raise ValueError(f"Instances of {name!r} in {self.path} have {len(positions)} positions, "
+                             f"but {scales.size} scales")
+        # Масштаб делит луч при переходе в систему сетки, а отрицательный вывернул бы нормали и рамки
+        invalid = np.flatnonzero(~(np.isfinite(scales) & (scales > 0)))
+        if invalid.size:
+            raise ValueError(f"Instance {int(invalid[0])} of {name!r} in {self.path} has scale {scales[invalid[0]]}, "
+                             f"scales must be positive and finite")
+        prototype = self.prototypes[name]
+        objects = []
+
+        spheres = [obj for obj in prototype if isinstance(obj, (Sphere, SphereSet))]
+        if spheres:
+            centers, radii, material_indices, materials = [], [], [], []
+            for obj in spheres:
+                if isinstance(obj, Sphere):
+                    centers.append(np.array([[obj.center.x], [obj.center.y], [obj.center.z]]))
+                    radii.append(np.array([obj.radius], dtype=np.float64))
+                    material_indices.append(np.array([len(materials)], dtype=np.int32))
+                    materials.append(obj)
+                else:
+                    centers.append(obj.centers)
+                    radii.append(obj.radii)
+                    material_indices.append(obj.material_indices + len(materials))
+                    materials += obj.materials
+            centers, radii = np.concatenate(centers, axis=1), np.concatenate(radii)
+            objects.append(SphereSet(
+                (centers[:, None, :] * scales[:, None] + positions.T[:, :, None]).reshape(3, -1),
+                (radii * scales[:, None]).ravel(), np.tile(np.concatenate(material_indices), len(positions)),
+                materials))
+
+        for obj in prototype:
+            if isinstance(obj, Mesh):
+                objects.append(MeshInstances(obj, positions, scales))
+            elif not isinstance(obj, (Sphere, SphereSet)):
+                raise ValueError(f"Prototype {name!r} in {self.path} can only hold spheres and meshes, not {obj!r}")
+        return objects
+
+
+def load_scene(path: str) -> Scene:
+    return Scene(path)
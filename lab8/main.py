@@ -1,114 +1,226 @@
-from sys import exit
 import pygame as pg
+from collections import deque
 from datetime import datetime
-
-from objects import Sphere, InfinityChessBoard
-from camera import Camera
-from skybox import Skybox
-from vector import Vector
-from light import Light
-from ray import Ray
-import random
-
-pg.init()
-pg.display.init()
-
-screen_size = Vector(1440, 850)
-shadow_bias = 0.0001
-max_reflections = 6
-samples_per_pixel = 10
-
-display = pg.display.set_mode((screen_size.x, screen_size.y))
-pg.display.set_caption("Python Raytracer")
-
-pixel_array = pg.PixelArray(display)
-
-camera = Camera(Vector(0, 0, 5), screen_size, 60, focus_distance=15.0, aperture=0.5)
-skybox = Skybox("skybox.png")
-
-objects = [
-    Sphere(Vector(0, -2, -10), 2, Vector(1, 0, 0), Vector(1, 1, 1), Vector(0.1, 0.1, 0.1), 32),
-    Sphere(Vector(5,-2, -15), 2, Vector(0, 1, 0), Vector(1, 1, 1), Vector(0.1, 0.1, 0.1), 32),
-    Sphere(Vector(-5, 0, -15), 2, Vector(0, 0, 1), Vector(1, 1, 1), Vector(0.1, 0.1, 0.1), 32),
-    InfinityChessBoard(2, Vector(0, 0, 0), Vector(1, 1, 1))
-]
-
-light = Light(Vector(-1, 1, -1), 1, Vector(1, 1, 1), Vector(1, 1, 1), Vector(0.2, 0.2, 0.2))
-
-
-def trace_ray(ray: Ray) -> Vector:
-    color = Vector(0, 0, 0)
-    intersect, obj = ray.cast(objects)
-    normal = False
-    if intersect:
-        normal = obj.get_normal(intersect)
-
-        # Ambient component
-        ambient = obj.ambient_color * light.ambient_color
-
-        # Diffuse component
-        light_dir = -light.direction.normalize()
-        diffuse_intensity = max(0, normal.dot(light_dir)) * light.strength
-        diffuse = obj.diffuse_color * light.diffuse_color * diffuse_intensity
-
-        # Specular component
-        view_dir = (camera.position - intersect).normalize()
-        reflect_dir = (normal * (2 * normal.dot(light_dir))) - light_dir
-        specular_intensity = max(0, view_dir.dot(reflect_dir)) ** obj.shininess
-        specular = obj.specular_color * light.specular_color * specular_intensity
-
-        # Combine all components
-        color = ambient + diffuse + specular
-
-        # Calculate shadows
-        light_ray = Ray(intersect + normal * shadow_bias, light_dir)
-        light_intersect, _ = light_ray.cast(objects)
-        if light_intersect:
-            color *= 0.1 / light.strength
-        else:
-            color *= normal.dot(-light.direction * light.strength)
-
+from multiprocessing import cpu_count
+from threading import Event, Thread
+import numpy as np
+from PIL import Image
+
+from scene import screen_size, samples_per_pixel, shadow_bias, max_reflections, min_throughput, roulette_depth, \
+    camera, skybox, objects, lights, light_samples, sequence
+from batch import BatchRenderer, to_rgb
+from tiles import TileRenderer
+from adaptive import AdaptiveSampler
+from progressive import ProgressiveRenderer
+from checkpoint import Checkpoint
+from denoise import denoise
+from tracer import trace_pixel
+
+use_batch = True
+workers = cpu_count()
+tile_size = 32
+# None - фиксированные samples_per_pixel на каждый пиксель
+sampler = AdaptiveSampler(min_samples=4, max_samples=64, threshold=0.01)
+# Прогрессивный режим: превью, затем проходы по 1 сэмплу до samples_per_pixel или time_budget секунд
+progressive = False
+time_budget = None
+preview_scale = 4
+# Файл контрольной точки, например 'render.ckpt': после закрытия окна рендер продолжится с того же тайла
+checkpoint_path = None
+# Денойзер готового кадра по альбедо, нормалям и расстояниям первого попадания (aov_samples сэмплов на пиксель)
+use_denoiser = False
+aov_samples = 4
+# Окно перерисовывается и обрабатывает события refresh_rate раз в секунду, рендер идёт в фоновом потоке.
+# P или пробел - пауза, C - остановить рендер, S - сохранить текущий кадр, ESC - сохранить и выйти
+refresh_rate = 30
+
+
+class Frame:
+    # Кадр, общий для потока рендера и окна. Рендер пишет в image (у тайлов это сам разделяемый буфер)
+    # и отмечает готовые области в updates, окно раз в обновление переносит их на экран.
+    # Пауза и отмена проверяются между тайлами, проходами и пикселями, поэтому стороны не ждут друг друга
+    __slots__ = ('width', 'height', 'image', 'updates', 'running', 'cancelled', 'finished', 'tile_renderer')
+
+    def __init__(self, width: int, height: int, tile_renderer: TileRenderer | None = None):
+        self.width = width
+        self.height = height
+        self.image = np.zeros((height, width, 3), dtype=np.float32)
+        self.updates = deque()
+        self.running = Event()
+        self.running.set()
+        self.cancelled = Event()
+        self.finished = Event()
+        self.tile_renderer = tile_renderer
+
+    def __repr__(self) -> str:
+        return f"Frame(size: {self.width}x{self.height}, status: {self.status})"
+
+    @property
+    def status(self) -> str:
+        if self.cancelled.is_set():
+            return "stopped"
+        if self.finished.is_set():
+            return "done"
+        return "rendering" if self.running.is_set() else "paused"
+
+    def show(self, image: np.ndarray):
+        self.image = image
+        self.updates.append((0, 0, self.width, self.height))
+
+    def update(self, tile: tuple):
+        self.updates.append(tile)
+
+    def wait(self) -> bool:
+        # Для потока рендера: ждёт снятия паузы, False - рендер остановлен
+        self.running.wait()
+        return not self.cancelled.is_set()
+
+    def pause(self):
+        self.running.clear()
+        if self.tile_renderer is not None:
+            self.tile_renderer.pause()
+
+    def resume(self):
+        self.running.set()
+        if self.tile_renderer is not None:
+            self.tile_renderer.resume()
+
+    def cancel(self):
+        self.cancelled.set()
+        self.running.set()
+        if self.tile_renderer is not None:
+            self.tile_renderer.cancel()
+
+    def save(self, path: str) -> Thread:
+        # Копия в uint8 снимается сразу, PNG кодируется в своём потоке: ни окно, ни рендер не ждут диска
+        image = to_rgb(self.image)
+        thread = Thread(target=lambda: Image.fromarray(image).save(path))
+        thread.start()
+        return thread
+
+
+def draw(surface: pg.Surface, x0: int, y0: int, colors: np.ndarray):
+    # Клиппинг и перевод в uint8 массивами, в окно - один blit_array на обновляемую область.
+    # surfarray индексирует [x, y], поэтому (H, W, 3) передаётся транспонированным видом без копии
+    height, width = colors.shape[:2]
+    pg.surfarray.blit_array(surface.subsurface((x0, y0, width, height)), to_rgb(colors).swapaxes(0, 1))
+
+
+def refresh(display: pg.Surface, frame: Frame):
+    rects = []
+    while frame.updates:
+        x0, y0, x1, y1 = frame.updates.popleft()
+        draw(display, x0, y0, frame.image[y0:y1, x0:x1])
+        rects.append((x0, y0, x1 - x0, y1 - y0))
+    if rects:
+        pg.display.update(rects)
+
+
+def render(frame: Frame, checkpoint: Checkpoint | None):
+    # Поток рендера: ресурсы создаёт и закрывает главный поток, здесь только заполнение кадра
+    tile_renderer = frame.tile_renderer
+    if tile_renderer is None:
+        for y in range(frame.height):
+            for x in range(frame.width):
+                if not frame.wait():
+                    return
+                color = trace_pixel(x, y, samples_per_pixel)
+                frame.image[y, x] = color.x, color.y, color.z
+            frame.update((0, y, frame.width, y + 1))
+    elif progressive:
+        progressive_renderer = ProgressiveRenderer(tile_renderer, preview_scale)
+        frame.show(progressive_renderer.preview())
+        for image in progressive_renderer.render(samples_per_pixel, time_budget):
+            frame.show(image)
+            if not frame.wait():
+                return
+        if use_denoiser and progressive_renderer.passes:
+            framebuffer = tile_renderer.framebuffer
+            frame.show(denoise(progressive_renderer.image(), framebuffer.albedo, framebuffer.normals,
+                               framebuffer.depth))
     else:
-        color = skybox.get_image_coords(ray.direction)
-    return color, intersect, normal
-
-
-for y in range(pg.display.get_window_size()[1]):
-    for x in range(pg.display.get_window_size()[0]):
-        color_sum = Vector(0, 0, 0)
-        for _ in range(samples_per_pixel):
-            ray = camera.get_direction(Vector(x + random.uniform(-0.5, 0.5), y + random.uniform(-0.5, 0.5)))
-            color, intersect, normal = trace_ray(ray)
-            if intersect:
-                reflection_ray = Ray(intersect + ray.direction.reflect(normal) * shadow_bias, ray.direction.reflect(normal))
-                reflection_color = Vector(0, 0, 0)
-                reflection_times = 0
-                for reflection in range(max_reflections):
-                    new_color, intersect, normal = trace_ray(reflection_ray)
-                    if intersect and not isinstance(object,
-                                                    InfinityChessBoard):  # Пропускаем отражение от шахматной доски
-                        reflection_color += new_color
-                        reflection_times += 1
-                        reflection_ray = Ray(intersect + reflection_ray.direction.reflect(normal) * shadow_bias,
-                                             reflection_ray.direction.reflect(normal))
-                    else:
-                        break
-                color += reflection_color / reflection_times
-            color_sum += color
-        avg_color = color_sum / samples_per_pixel
-        pixel_array[x, y] = avg_color.to_rgb()
-
-    pg.display.flip()
-    for event in pg.event.get():
-        if event.type == pg.QUIT:
-            pg.quit()
-            exit()
-
-while True:
-    for event in pg.event.get():
-        if event.type == pg.QUIT or (event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE):
-            current_time = datetime.now().strftime("%d%m%Y%H%M%S")
-            file_name = f"file_{current_time}.png"
-            pg.image.save(display, file_name)
-            pg.quit()
-            exit()
\ No newline at end of file
+        resumed = checkpoint is not None and (checkpoint.passes > 0 or checkpoint.done.any())
+        tiles = tile_renderer.render(samples_per_pixel) if checkpoint is None \
+            else checkpoint.render(tile_renderer, samples_per_pixel)
+        for tile in tiles:
+            frame.update(tile)
+        if not frame.wait():
+            return
+        # Копия: разделяемый кадр освобождается вместе с tile_renderer
+        framebuffer = tile_renderer.framebuffer
+        image = framebuffer.array.copy() if checkpoint is None else checkpoint.image()
+        if use_denoiser and resumed:
+            # У тайлов прошлого запуска нет буферов денойзера: дешёвый проход одних AOV по всему кадру
+            for _ in tile_renderer.render_aovs(checkpoint.seed):
+                pass
+        if use_denoiser:
+            # Дисперсия сэмплов есть только у фиксированного числа сэмплов, отрендеренного целиком сейчас
+            variance = framebuffer.variance if sampler is None and checkpoint is None and samples_per_pixel > 1 \
+                else None
+            image = denoise(image, framebuffer.albedo, framebuffer.normals, framebuffer.depth, variance)
+        frame.show(image)
+    frame.finished.set()
+
+
+def main():
+    pg.init()
+    pg.display.init()
+
+    display = pg.display.set_mode((screen_size.x, screen_size.y))
+    pg.display.set_caption("Python Raytracer")
+
+    renderer = BatchRenderer(objects, lights, camera, skybox, shadow_bias, max_reflections, sequence=sequence,
+                             min_throughput=min_throughput, roulette_depth=roulette_depth, light_samples=light_samples)
+
+    width, height = pg.display.get_window_size()
+    tile_renderer = checkpoint = None
+    if use_batch:
+        tile_renderer = TileRenderer(renderer, width, height, tile_size, workers, None if progressive else sampler,
+                                     aov_samples if use_denoiser else 0)
+    frame = Frame(width, height, tile_renderer)
+    if tile_renderer is not None and not progressive:
+        frame.image = tile_renderer.framebuffer.array
+        if checkpoint_path:
+            checkpoint = Checkpoint(checkpoint_path, width, height, tile_size, resume=True)
+            frame.image[:] = checkpoint.image()
+            frame.show(frame.image)
+
+    thread = Thread(target=render, args=(frame, checkpoint), daemon=True)
+    thread.start()
+    clock = pg.time.Clock()
+    status = None
+    try:
+        while True:
+            for event in pg.event.get():
+                if event.type == pg.QUIT or (event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE):
+                    frame.cancel()
+                    frame.save(f"file_{datetime.now().strftime('%d%m%Y%H%M%S')}.png")
+                    return
+                if event.type != pg.KEYDOWN:
+                    continue
+                if event.key in (pg.K_p, pg.K_SPACE) and frame.status == "rendering":
+                    frame.pause()
+                elif event.key in (pg.K_p, pg.K_SPACE) and frame.status == "paused":
+                    frame.resume()
+                elif event.key == pg.K_c:
+                    frame.cancel()
+                elif event.key == pg.K_s:
+                    frame.save(f"file_{datetime.now().strftime('%d%m%Y%H%M%S')}.png")
+            refresh(display, frame)
+            if frame.status != status:
+                status = frame.status
+                pg.display.set_caption(f"Python Raytracer - {status}")
+            clock.tick(refresh_rate)
+    finally:
+        frame.cancel()
+        pg.quit()
+        # Поток рендера останавливается после текущего тайла, затем освобождаются воркеры и разделяемый кадр
+        thread.join()
+        if tile_renderer is not None:
+            tile_renderer.close()
+        if checkpoint is not None:
+            checkpoint.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+from math import inf
+
+import numpy as np
+
+from vector import Vector
+from bvh import BVH
+
+# Переход из системы координат модели в систему трассировщика, где ось y направлена вниз
+UP_AXES = {
+    'y': np.array([[1, 0, 0], [0, -1, 0], [0, 0, -1]], dtype=np.float64),
+    'z': np.array([[1, 0, 0], [0, 0, -1], [0, 1, 0]], dtype=np.float64),
+}
+
+
+def load_obj(path: str) -> tuple:
+    vertices, faces = [], []
+    with open(path) as file:
+        for line in file:
+            if line.startswith('v '):
+                vertices.append(line.split()[1:4])
+            elif line.startswith('f '):
+                # v, v/vt, v//vn, v/vt/vn; отрицательные индексы считаются от конца
+                face = [int(token.split('/')[0]) for token in line.split()[1:]]
+                face = [index - 1 if index > 0 else len(vertices) + index for index in face]
+                faces.extend((face[0], face[i], face[i + 1]) for i in range(1, len(face) - 1))
+    return np.array(vertices, dtype=np.float32).reshape(-1, 3), np.array(faces, dtype=np.int32).reshape(-1, 3)
+
+
+def shear_rays(directions: np.ndarray) -> tuple:
+    # Подготовка лучей для watertight-теста (Woo, Benthin, Wald 2013): ось kz вдоль наибольшей компоненты
+    rays = np.arange(directions.shape[1])
+    kz = np.argmax(np.abs(directions), axis=0)
+    kx = (kz + 1) % 3
+    ky = (kx + 1) % 3
+    negative = directions[kz, rays] < 0
+    kx, ky = np.where(negative, ky, kx), np.where(negative, kx, ky)
+    sz = 1 / directions[kz, rays]
+    return kx, ky, kz, directions[kx, rays] * sz, directions[ky, rays] * sz, sz
+
+
+def triangle_distance(v0: np.ndarray, v1: np.ndarray, v2: np.ndarray, origins: np.ndarray,
+                      directions: np.ndarray) -> np.ndarray:
+    rays = np.arange(origins.shape[1])
+    kx, ky, kz, sx, sy, sz = shear_rays(directions)
+    a, b, c = v0 - origins, v1 - origins, v2 - origins
+    ax, ay = a[kx, rays] - sx * a[kz, rays], a[ky, rays] - sy * a[kz, rays]
+    bx, by = b[kx, rays] - sx * b[kz, rays], b[ky, rays] - sy * b[kz, rays]
+    cx, cy = c[kx, rays] - sx * c[kz, rays], c[ky, rays] - sy * c[kz, rays]
+    u = cx * by - cy * bx
+    v = ax * cy - ay * cx
+    w = bx * ay - by * ax
+    inside = ~(((u < 0) | (v < 0) | (w < 0)) & ((u > 0) | (v > 0) | (w > 0)))
+    det = u + v + w
+    t = u * (sz * a[kz, rays]) + v * (sz * b[kz, rays]) + w * (sz * c[kz, rays])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distance = t / det
+    return np.where(inside & (det != 0) & (distance > 0), distance, inf)
+
+
+class MeshFace:
+    __slots__ = ('mesh', 'index', 'normal')
+
+    def __init__(self, mesh: Mesh, index: int, normal: Vector):
+        self.mesh = mesh
+        self.index = index
+        self.normal = normal
+
+    def __repr__(self) -> str:
+        return f"MeshFace(index: {self.index}, normal: {self.normal})"
+
+    def __getattr__(self, name: str):
+        # Цвета и блеск берутся у сетки
+        return getattr(self.mesh, name)
+
+    def get_normal(self, hit_position: Vector) -> Vector:
+        return self.normal
+
+
+class Mesh:
+    __slots__ = ('vertices', 'indices', 'normals', 'diffuse_color', 'specular_color', 'ambient_color', 'shininess',
+                 'reflectivity', 'tree')
+
+    def __init__(self, vertices: np.ndarray, indices: np.ndarray, diffuse_color: Vector, specular_color: Vector,
+                 ambient_color: Vector, shininess: float, reflectivity: float = 0.5):
+        self.vertices = np.ascontiguousarray(vertices, dtype=np.float32)
+        self.indices = np.ascontiguousarray(indices, dtype=np.int32)
+        self.diffuse_color = diffuse_color
+        self.specular_color = specular_color
+        self.ambient_color = ambient_color
+        self.shininess = shininess
+        self.reflectivity = reflectivity
+        triangles = self.vertices[self.indices].astype(np.float64)
+        normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.normals = (normals / np.linalg.norm(normals, axis=1, keepdims=True)).astype(np.float32)
+        self.tree = BVH(triangles.min(axis=1), triangles.max(axis=1))
+
+    def __repr__(self) -> str:
+        return f"Mesh(vertices: {len(self.vertices)}, triangles: {len(self.indices)})"
+
+    @classmethod
+    def load(cls, path: str, position: Vector, scale: float, diffuse_color: Vector, specular_color: Vector,
+             ambient_color: Vector, shininess: float, up: str = 'z', reflectivity: float = 0.5) -> Mesh:
+        vertices, indices = load_obj(path)
+        vertices = vertices @ (UP_AXES[up].T * scale) + np.array([position.x, position.y, position.z])
+        return cls(vertices, indices, diffuse_color, specular_color, ambient_color, shininess, reflectivity)
+
+    def bounds(self) -> tuple:
+        lower, upper = self.vertices.min(axis=0).tolist(), self.vertices.max(axis=0).tolist()
+        return Vector(*lower), Vector(*upper)
+
+    def triangle_distance(self, origins: np.ndarray, directions: np.ndarray, triangles: np.ndarray) -> np.ndarray:
+        corners = self.vertices[self.indices[triangles]].astype(np.float64)
+        return triangle_distance(corners[:, 0].T, corners[:, 1].T, corners[:, 2].T, origins, directions)
+
+    def intersect(self, origins: np.ndarray, directions: np.ndarray, t: np.ndarray, any_hit: bool = False) -> tuple:
+        triangles = np.full(t.size, -1, dtype=np.int64)
+        self.tree.intersect(origins, directions, t, triangles, self.triangle_distance, any_hit)
+        return t, triangles
+
+    def get_normals(self, triangles: np.ndarray, directions: np.ndarray) -> np.ndarray:
+        # Треугольники двусторонние: нормаль разворачиваем навстречу лучу
+        normals = self.normals[triangles].T.astype(np.float64)
+        facing = (normals * directions).sum(axis=0) > 0
+        normals[:, facing] *= -1
+        return normals
+
+    def hit(self, ray) -> tuple:
+        origin = np.array([[ray.origin.x], [ray.origin.y], [ray.origin.z]], dtype=np.float64)
+        direction = np.array([[ray.direction.x], [ray.direction.y], [ray.direction.z]], dtype=np.float64)
+        t, triangles = self.intersect(origin, direction, np.array([inf]))
+        if triangles[0] < 0:
+            return inf, None
+        normal = self.get_normals(triangles, direction)[:, 0].tolist()
+        return float(t[0]), MeshFace(self, int(triangles[0]), Vector(*normal))
+
+    def distance(self, ray) -> float:
+        return self.hit(ray)[0]
+
+
+class MeshInstances:
+    # Копии одной сетки: сетка и её BVH общие, у каждой копии только сдвиг positions (m, 3) и масштаб scales (m,).
+    # Верхний BVH над рамками копий выбирает, какие проверять; луч переводится в систему сетки,
+    # где p = (p_мира - position) / scale, а расстояние вдоль того же направления делится на scale.
+    # Масштаб равномерный, поэтому нормали сетки подходят всем копиям
+    __slots__ = ('mesh', 'positions', 'scales', 'diffuse_color', 'specular_color', 'ambient_color', 'shininess',
+                 'reflectivity', 'tree')
+
+    def __init__(self, mesh: Mesh, positions: np.ndarray, scales: np.ndarray):
+        self.mesh = mesh
+        self.positions = np.ascontiguousarray(positions, dtype=np.float64).reshape(-1, 3)
+        self.scales = np.ascontiguousarray(scales, dtype=np.float64).reshape(-1)
+        # Материал у всех копий тот же, что у прототипа
+        self.diffuse_color = mesh.diffuse_color
+        self.specular_color = mesh.specular_color
+        self.ambient_color = mesh.ambient_color
+        self.shininess = mesh.shininess
+        self.reflectivity = mesh.reflectivity
+        lower = mesh.vertices.min(axis=0).astype(np.float64) * self.scales[:, None] + self.positions
+        upper = mesh.vertices.max(axis=0).astype(np.float64) * self.scales[:, None] + self.positions
+        self.tree = BVH(np.minimum(lower, upper), np.maximum(lower, upper))
+
+    def __repr__(self) -> str:
+        return f"MeshInstances(instances: {len(self.scales)}, triangles: {len(self.mesh.indices)})"
+
+    def bounds(self) -> tuple:
+        return Vector(*self.tree.lower[0].tolist()), Vector(*self.tree.upper[0].tolist())
+
+    def intersect(self, origins: np.ndarray, directions: np.ndarray, t: np.ndarray, any_hit: bool = False) -> tuple:
+        # Верхний BVH даёт пары (луч, копия), все пары идут в общий BVH сетки одним вызовом,
+        # затем у каждого луча остаётся ближайшее попадание
+        rays, instances = self.tree.candidates(origins, directions, t)
+        scales = self.scales[instances]
+        local = (origins[:, rays] - self.positions[instances].T) / scales
+        pair_t, pair_triangles = self.mesh.intersect(local, directions[:, rays], t[rays] / scales, any_hit)
+        hit = pair_triangles >= 0
+        rays, pair_t, pair_triangles = rays[hit], pair_t[hit] * scales[hit], pair_triangles[hit]
+        order = np.lexsort((pair_t, rays))
+        closest = order[np.r_[True, rays[order][1:] != rays[order][:-1]]] if order.size else order
+        triangles = np.full(t.size, -1, dtype=np.int64)
+        t[rays[closest]] = pair_t[closest]
+        triangles[rays[closest]] = pair_triangles[closest]
+        return t, triangles
+
+    def get_normals(self, triangles: np.ndarray, directions: np.ndarray) -> np.ndarray:
+        return self.mesh.get_normals(triangles, directions)
+
+    # Скалярный трассировщик: тот же разбор одного луча, что у сетки
+    hit = Mesh.hit
+    distance = Mesh.distance
@@ -1,51 +1,86 @@
 from __future__ import annotations
 
-from math import sqrt
+from math import sqrt, inf
+
+import numpy as np
 
 from vector import Vector
 from ray import Ray
+from bvh import BVH
+
+
+class Material:
+    __slots__ = ('diffuse_color', 'specular_color', 'ambient_color', 'shininess', 'reflectivity')
+
+    def __init__(self, diffuse_color: Vector, specular_color: Vector, ambient_color: Vector, shininess: float,
+                 reflectivity: float = 0.5):
+        self.diffuse_color = diffuse_color
+        self.specular_color = specular_color
+        self.ambient_color = ambient_color
+        self.shininess = shininess
+        self.reflectivity = reflectivity
+
+    def __repr__(self) -> str:
+        return f"Material(diffuse_color: {self.diffuse_color}, shininess: {self.shininess}, " \
+               f"reflectivity: {self.reflectivity})"
 
 
 class Sphere:
-    __slots__ = ('center', 'radius', 'diffuse_color', 'specular_color', 'ambient_color', 'shininess')
+    __slots__ = ('center', 'radius', 'diffuse_color', 'specular_color', 'ambient_color', 'shininess', 'reflectivity')
 
     def __init__(self, center: Vector, radius: float, diffuse_color: Vector, specular_color: Vector,
-                 ambient_color: Vector, shininess: float):
+                 ambient_color: Vector, shininess: float, reflectivity: float = 0.5):
         self.center = center
         self.radius = radius
         self.diffuse_color = diffuse_color
         self.specular_color = specular_color
         self.ambient_color = ambient_color
         self.shininess = shininess
+        # Доля отражённого света: множитель throughput пути на этой поверхности
+        self.reflectivity = reflectivity
 
     def __repr__(self) -> str:
         return f"Sphere(center: {self.center}, radius: {self.radius}, color: {self.color})"
 
-    def intersection(self, ray: Ray) -> bool | Vector:
-        l = self.center - ray.origin # вектор от начала луча до сцены
-        adj = l.dot(ray.direction) # проекция вектора на направление луча
-        d2 = l.dot(l) - (adj * adj) # раст. от центра луча до сферы (квадрат)
+    def bounds(self) -> tuple:
+        extent = Vector(self.radius, self.radius, self.radius)
+        return self.center - extent, self.center + extent
+
+    def distance(self, ray: Ray) -> float:
+        l = self.center.sub(ray.origin) # вектор от начала луча до сцены
+        adj = l.vdot(ray.direction) # проекция вектора на направление луча
+        d2 = l.vdot(l) - (adj * adj) # раст. от центра луча до сферы (квадрат)
         radius2 = self.radius * self.radius # квадрат радиуса сферы
         if d2 > radius2:
-            return False
+            return inf
         thc = sqrt(radius2 - d2)
         t0 = adj - thc # расстояние от начала луча до точек пересечения
         t1 = adj + thc
-        if t0 < 0 and t1 < 0:
+        if t0 > 0:
+            return t0 # ближайшая точка перед началом луча
+        if t1 > 0:
+            return t1 # начало луча внутри сферы
+        return inf
+
+    def hit(self, ray: Ray) -> tuple:
+        return self.distance(ray), self
+
+    def intersection(self, ray: Ray) -> bool | Vector:
+        distance = self.distance(ray)
+        if distance == inf:
             return False
-        distance = t0 if t0 < t1 else t1 # возвращаем ближайшую
-        return ray.origin + ray.direction * distance
+        return ray.origin.madd(ray.direction, distance)
 
     def get_color(self, hit_position: Vector) -> Vector:
         return self.diffuse_color
 
     def get_normal(self, hit_position: Vector) -> Vector:
-        return (hit_position - self.center).normalize()
+        return hit_position.sub(self.center).normalize()
 
 
 class InfinityChessBoard:
     __slots__ = ('y', 'color1', 'color2', 'ambient_color', 'diffuse_color', 'specular_color',
-                 'shininess')
+                 'shininess', 'reflectivity')
 
     def __init__(self, y: int | float, color1: Vector, color2: Vector):
         self.y = y
@@ -55,16 +90,27 @@ class InfinityChessBoard:
         self.diffuse_color = Vector(0.5, 0.5, 0.5)
         self.specular_color = Vector(0.5, 0.5, 0.5)
         self.shininess = 0.5
+        # Доска видна в отражениях, но сама не отражает
+        self.reflectivity = 0.0
 
     def __repr__(self) -> str:
         return f"Checkerboard(y: {self.y}, color1: {self.color1}, color2: {self.color2})"
 
-    def intersection(self, ray: Ray) -> bool | Vector:
-        if ray.direction.y < 0:
-            return False
+    def distance(self, ray: Ray) -> float:
+        if ray.direction.y <= 0:
+            return inf
         distance = self.y - ray.origin.y
         steps = distance / ray.direction.y
-        return ray.origin + ray.direction * steps
+        return steps if steps > 0 else inf
+
+    def hit(self, ray: Ray) -> tuple:
+        return self.distance(ray), self
+
+    def intersection(self, ray: Ray) -> bool | Vector:
+        steps = self.distance(ray)
+        if steps == inf:
+            return False
+        return ray.origin.madd(ray.direction, steps)
 
     def get_color(self, hit_position: Vector) -> Vector:
         if round(hit_position.x) % 6 <= 2 and round(hit_position.z) % 6 <= 2 or \
@@ -73,4 +119,50 @@ class InfinityChessBoard:
         return self.color2
 
     def get_normal(self, hit_position: Vector) -> Vector:
-        return Vector(0, -1, 0)
\ No newline at end of file
+        return Vector(0, -1, 0)
+
+
+class SphereSet:
+    # Много сфер одним объектом в виде столбцов: центры (3, n), радиусы (n,) и номера материалов (n,).
+    # Массивы могут быть отображены из файла; батч-рендерер сливает их со своими сферами без цикла по объектам
+    __slots__ = ('centers', 'radii', 'material_indices', 'materials', 'tree')
+
+    def __init__(self, centers: np.ndarray, radii: np.ndarray, material_indices: np.ndarray, materials: list):
+        self.centers = centers
+        self.radii = radii
+        self.material_indices = material_indices
+        self.materials = materials
+        # Дерево для скалярного трассировщика строится при первом обращении
+        self.tree = None
+
+    def __repr__(self) -> str:
+        return f"SphereSet(spheres: {len(self)}, materials: {len(self.materials)})"
+
+    def __len__(self) -> int:
+        return self.radii.size
+
+    def bounds(self) -> tuple:
+        lower = (self.centers - self.radii).min(axis=1).tolist()
+        upper = (self.centers + self.radii).max(axis=1).tolist()
+        return Vector(*lower), Vector(*upper)
+
+    def get_tree(self) -> BVH:
+        if self.tree is None:
+            self.tree = BVH((self.centers - self.radii).T, (self.centers + self.radii).T)
+        return self.tree
+
+    def get_sphere(self, index: int) -> Sphere:
+        material = self.materials[int(self.material_indices[index])]
+        return Sphere(Vector(*self.centers[:, index].tolist()), float(self.radii[index]), material.diffuse_color,
+                      material.specular_color, material.ambient_color, material.shininess, material.reflectivity)
+
+    def hit(self, ray: Ray) -> tuple:
+        origin = (ray.origin.x, ray.origin.y, ray.origin.z)
+        direction = (ray.direction.x, ray.direction.y, ray.direction.z)
+        t, index = self.get_tree().closest_hit(origin, direction, lambda index: self.get_sphere(index).distance(ray))
+        if index < 0:
+            return inf, None
+        return t, self.get_sphere(index)
+
+    def distance(self, ray: Ray) -> float:
+        return self.hit(ray)[0]
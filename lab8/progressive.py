@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+from time import perf_counter
+
+import numpy as np
+
+from tiles import TileRenderer, make_tiles
+from sequences import path_keys
+
+
+class ProgressiveRenderer:
+    __slots__ = ('tile_renderer', 'preview_scale', 'accumulation', 'passes')
+
+    def __init__(self, tile_renderer: TileRenderer, preview_scale: int = 4):
+        self.tile_renderer = tile_renderer
+        self.preview_scale = preview_scale
+        self.accumulation = np.zeros((tile_renderer.height, tile_renderer.width, 3), dtype=np.float32)
+        self.passes = 0
+
+    def __repr__(self) -> str:
+        return f"ProgressiveRenderer(passes: {self.passes}, preview_scale: {self.preview_scale})"
+
+    def image(self) -> np.ndarray:
+        return self.accumulation / max(self.passes, 1)
+
+    def preview(self, seed: int = 0) -> np.ndarray:
+        # Один луч через центральный пиксель каждого блока preview_scale x preview_scale, растянутый на весь блок
+        width, height, scale = self.tile_renderer.width, self.tile_renderer.height, self.preview_scale
+        renderer = self.tile_renderer.renderer
+        ys, xs = np.meshgrid(np.minimum(np.arange(0, height, scale) + scale // 2, height - 1),
+                             np.minimum(np.arange(0, width, scale) + scale // 2, width - 1), indexing='ij')
+        shape = xs.shape
+        xs, ys = xs.ravel(), ys.ravel()
+        indices = np.zeros(xs.size, dtype=np.int64)
+        lens = renderer.sequence.sample(xs, ys, indices, seed)[2]
+        rays = renderer.pixel_rays(xs, ys, lens)
+        colors = renderer.radiance(rays, path_keys(seed, xs, ys, indices))
+        image = colors.T.reshape(*shape, 3).repeat(scale, axis=0).repeat(scale, axis=1)
+        return image[:height, :width].astype(np.float32)
+
+    def render(self, max_samples: int | None = None, time_budget: float | None = None, seed: int | None = None):
+        # Проходы по 1 сэмплу на пиксель, после каждого отдаём текущее среднее
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        start = perf_counter()
+        while (max_samples is None or self.passes < max_samples) and \
+                (time_budget is None or perf_counter() - start < time_budget):
+            finished = sum(1 for _ in self.tile_renderer.render(1, seed, stream=self.passes))
+            if finished < len(make_tiles(self.tile_renderer.width, self.tile_renderer.height,
+                                         self.tile_renderer.tile_size)):
+                # Рендер отменён посреди прохода: неполный проход не накапливается
+                return
+            self.accumulation += self.tile_renderer.framebuffer.array
+            self.passes += 1
+            yield self.image()
@@ -1,4 +1,9 @@
+from __future__ import annotations
+
+from math import inf
+
 from vector import Vector
+from bvh import ObjectBVH
 
 
 class Ray:
@@ -11,9 +16,24 @@ class Ray:
     def __repr__(self) -> str:
         return f"Ray(origin: {self.origin}, direction: {self.direction})"
 
-    def cast(self, objects: list) -> tuple:
+    def cast(self, objects: list | ObjectBVH) -> tuple:
+        # Ближайшее пересечение, а не первое по списку
+        if isinstance(objects, ObjectBVH):
+            return objects.cast(self)
+        closest, closest_object = inf, False
+        for object in objects:
+            distance, hit_object = object.hit(self)
+            if distance < closest:
+                closest, closest_object = distance, hit_object
+        if closest_object is False:
+            return False, False
+        return self.origin.madd(self.direction, closest), closest_object
+
+    def occluded(self, objects: list | ObjectBVH, t_max: float = inf) -> bool:
+        # Любое пересечение ближе t_max: для теневых лучей точка и ближайший объект не нужны
+        if isinstance(objects, ObjectBVH):
+            return objects.occluded(self, t_max)
         for object in objects:
-            intersect = object.intersection(self)
-            if intersect:
-                return intersect, object
-        return False, False
+            if object.distance(self) < t_max:
+                return True
+        return False
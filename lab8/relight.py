@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import os
+from argparse import ArgumentParser
+from importlib import import_module, reload
+from time import perf_counter, sleep
+
+import numpy as np
+from PIL import Image
+
+from batch import BatchRenderer, to_rgb
+from loader import load_scene
+from sequences import path_keys
+from vector import Vector
+
+
+class GBuffer:
+    # Первые попадания кадра для перерасчёта освещения без повторной трассировки: точка, нормаль, направление
+    # луча и номер материала для попаданий, цвет неба для промахов. Сэмпл index пикселя (x, y) лежит под
+    # номером (index * height + y) * width + x в hit; массивы попаданий и промахов хранят только свои элементы
+    __slots__ = ('width', 'height', 'samples', 'seed', 'hit', 'points', 'normals', 'directions', 'materials', 'sky')
+
+    def __init__(self, width: int, height: int, samples: int, seed: int, hit: np.ndarray, points: np.ndarray,
+                 normals: np.ndarray, directions: np.ndarray, materials: np.ndarray, sky: np.ndarray):
+        self.width = width
+        self.height = height
+        self.samples = samples
+        self.seed = seed
+        self.hit = hit
+        self.points = points
+        self.normals = normals
+        self.directions = directions
+        self.materials = materials
+        self.sky = sky
+
+    def __repr__(self) -> str:
+        return f"GBuffer(size: {self.width}x{self.height}, samples: {self.samples}, hits: {self.materials.size})"
+
+    @classmethod
+    def capture(cls, renderer: BatchRenderer, width: int, height: int, samples: int = 1, seed: int = 0) -> GBuffer:
+        # Те же первичные лучи, что у renderer.render(0, 0, width, height, samples, seed)
+        xs, ys, indices = cls.coordinates(width, height, samples)
+        hit = np.zeros(xs.size, dtype=bool)
+        hits = {'points': [], 'normals': [], 'directions': [], 'materials': []}
+        sky = []
+        for start in range(0, xs.size, renderer.chunk_size):
+            part = slice(start, start + renderer.chunk_size)
+            points = renderer.sequence.sample(xs[part], ys[part], indices[part], seed)
+            rays = renderer.intersect(renderer.primary_rays(xs[part] + points[0] - 0.5, ys[part] + points[1] - 0.5,
+                                                            points[2]))
+            mask = hit[part] = rays.hit()
+            points = rays.origins[:, mask] + rays.directions[:, mask] * rays.t[mask]
+            hits['points'].append(points.astype(np.float32))
+            hits['normals'].append(renderer.get_normals(rays, points, mask).astype(np.float32))
+            hits['directions'].append(rays.directions[:, mask].astype(np.float32))
+            hits['materials'].append(renderer.get_materials(rays, mask).astype(np.int32))
+            sky.append(renderer.skybox.get_image_colors(rays.directions[:, ~mask]).astype(np.float32))
+        return cls(width, height, samples, seed, hit, np.hstack(hits['points']), np.hstack(hits['normals']),
+                   np.hstack(hits['directions']), np.concatenate(hits['materials']), np.hstack(sky))
+
+    @staticmethod
+    def coordinates(width: int, height: int, samples: int) -> tuple:
+        ys, xs = np.divmod(np.arange(width * height), width)
+        return (np.tile(xs, samples).astype(np.float64), np.tile(ys, samples).astype(np.float64),
+                np.repeat(np.arange(samples), width * height))
+
+    def shade(self, renderer: BatchRenderer, reflections: bool = False) -> np.ndarray:
+        # Освещение по кешу: заново трассируются только теневые лучи, с reflections - ещё и отражения.
+        # Источники и материалы берутся из renderer, см. set_lights и set_materials
+        xs, ys, indices = self.coordinates(self.width, self.height, self.samples)
+        hits = np.flatnonzero(self.hit)
+        keys = path_keys(self.seed, xs[hits], ys[hits], indices[hits])
+        colors = np.empty((3, self.hit.size))
+        colors[:, ~self.hit] = self.sky
+        for start in range(0, hits.size, renderer.chunk_size):
+            part = slice(start, start + renderer.chunk_size)
+            points = self.points[:, part].astype(np.float64)
+            normals = self.normals[:, part].astype(np.float64)
+            materials = self.materials[part].astype(np.int64)
+            local = renderer.shade(points, normals, materials, keys[part], 0)
+            if reflections and renderer.max_reflections > 0:
+                throughput = np.ones(materials.size)
+                index, rays = renderer.scatter(self.directions[:, part].astype(np.float64), points, normals,
+                                               materials, np.arange(materials.size), keys[part], throughput, 0)
+                if index.size:
+                    renderer.follow(rays, keys[part], local, throughput, index, 1)
+            colors[:, hits[part]] = local
+        colors = colors.reshape(3, self.samples, self.height, self.width).mean(axis=1)
+        return colors.transpose(1, 2, 0).astype(np.float32)
+
+    def save(self, path: str):
+        np.savez(path, size=[self.width, self.height, self.samples, self.seed], hit=self.hit, points=self.points,
+                 normals=self.normals, directions=self.directions, materials=self.materials, sky=self.sky)
+
+    @classmethod
+    def load(cls, path: str) -> GBuffer:
+        with np.load(path) as data:
+            width, height, samples, seed = (int(value) for value in data['size'])
+            return cls(width, height, samples, seed, data['hit'], data['points'], data['normals'], data['directions'],
+                       data['materials'], data['sky'])
+
+
+def parse_args(argv: list | None = None):
+    parser = ArgumentParser(description="Cache the first hits of a lab8 frame and re-shade it when lights or "
+                                        "materials change")
+    parser.add_argument('--scene', default='scene', help="module or JSON scene file")
+    parser.add_argument('--width', type=int, default=1440)
+    parser.add_argument('--height', type=int, default=850)
+    parser.add_argument('--spp', type=int, default=1, help="cached samples per pixel")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--reflections', action='store_true', help="trace reflections, not only shadow rays")
+    parser.add_argument('--gbuffer', default=None, help=".npz with the cached hits, written if it does not exist")
+    parser.add_argument('--watch', action='store_true',
+                        help="re-shade every time the scene file changes; geometry and camera stay cached")
+    parser.add_argument('--out', default='relit.png')
+    return parser.parse_args(argv)
+
+
+def load(name: str, module=None):
+    if os.path.isfile(name):
+        return load_scene(name)
+    return reload(module) if module is not None else import_module(name)
+
+
+def main(argv: list | None = None):
+    args = parse_args(argv)
+    scene = load(args.scene)
+    scene.camera.screen_size = Vector(args.width, args.height)
+    renderer = BatchRenderer(scene.objects, scene.lights, scene.camera, scene.skybox, scene.shadow_bias,
+                             scene.max_reflections, sequence=scene.sequence, min_throughput=scene.min_throughput,
+                             roulette_depth=scene.roulette_depth, light_samples=getattr(scene, 'light_samples', 1))
+
+    start = perf_counter()
+    if args.gbuffer and os.path.exists(args.gbuffer):
+        gbuffer = GBuffer.load(args.gbuffer)
+        if (gbuffer.width, gbuffer.height) != (args.width, args.height):
+            raise SystemExit(f"{args.gbuffer} is {gbuffer.width}x{gbuffer.height}, not {args.width}x{args.height}")
+    else:
+        gbuffer = GBuffer.capture(renderer, args.width, args.height, args.spp, args.seed)
+        if args.gbuffer:
+            gbuffer.save(args.gbuffer)
+    print(f"{gbuffer}: {perf_counter() - start:.2f} s")
+
+    path = args.scene if os.path.isfile(args.scene) else import_module(args.scene).__file__
+    while True:
+        start = perf_counter()
+        Image.fromarray(to_rgb(gbuffer.shade(renderer, args.reflections))).save(args.out)
+        print(f"{args.out}: shaded in {perf_counter() - start:.2f} s")
+        if not args.watch:
+            return
+        modified = os.path.getmtime(path)
+        while os.path.getmtime(path) == modified:
+            sleep(0.5)
+        try:
+            scene = load(args.scene, None if os.path.isfile(args.scene) else scene)
+            renderer.set_lights(scene.lights)
+            renderer.set_materials(scene.objects)
+        except Exception as error:
+            # Ошибка в редактируемом файле не должна обрывать сессию: ждём следующего сохранения
+            print(f"{args.scene}: {error}")
+
+
+if __name__ == '__main__':
+    main()
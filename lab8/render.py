@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import os
+from argparse import ArgumentParser
+from datetime import datetime
+from importlib import import_module
+from time import perf_counter
+
+import numpy as np
+from PIL import Image
+
+from batch import BatchRenderer, to_rgb
+from tiles import TileRenderer
+from adaptive import AdaptiveSampler, heatmap
+from progressive import ProgressiveRenderer
+from checkpoint import Checkpoint
+from denoise import denoise
+from farm import Coordinator
+from stream import render_stream
+from loader import load_scene
+from stats import RenderStats
+from sequences import SEQUENCES, make_sequence
+from vector import Vector
+
+
+def parse_args(argv: list | None = None):
+    parser = ArgumentParser(description="Render a lab8 scene without opening a window")
+    parser.add_argument('--scene', default='scene',
+                        help="module or JSON scene file with objects, light, camera and skybox")
+    parser.add_argument('--width', type=int, default=1440)
+    parser.add_argument('--height', type=int, default=850)
+    parser.add_argument('--spp', type=int, default=10, help="samples per pixel")
+    parser.add_argument('--adaptive', action='store_true', help="sample until the per-pixel error is below threshold")
+    parser.add_argument('--min-spp', type=int, default=4)
+    parser.add_argument('--max-spp', type=int, default=64)
+    parser.add_argument('--threshold', type=float, default=0.01, help="standard error of pixel luminance")
+    parser.add_argument('--heatmap', default=None, help="PNG with the per-pixel sample count")
+    parser.add_argument('--progressive', action='store_true',
+                        help="add 1 spp passes up to --spp, rewriting --out after every pass")
+    parser.add_argument('--time-budget', type=float, default=None, help="stop progressive passes after N seconds")
+    parser.add_argument('--max-reflections', type=int, default=6)
+    parser.add_argument('--min-throughput', type=float, default=0.01, help="stop paths that contribute less")
+    parser.add_argument('--roulette-depth', type=int, default=2, help="bounces before Russian roulette starts")
+    parser.add_argument('--light-samples', type=int, default=None,
+                        help="shadow rays per hit, the scene's light_samples by default")
+    parser.add_argument('--sequence', choices=SEQUENCES, default='sobol', help="pixel and lens sample sequence")
+    parser.add_argument('--sky-bilinear', action='store_true', help="bilinear filtering of the skybox")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--tile-size', type=int, default=32)
+    parser.add_argument('--out', default=None, help="output PNG, file_<timestamp>.png by default")
+    parser.add_argument('--checkpoint', default=None, help="memory-mapped file with the accumulated samples")
+    parser.add_argument('--resume', action='store_true', help="continue from --checkpoint if it exists")
+    parser.add_argument('--flush-interval', type=float, default=10.0, help="seconds between checkpoint flushes")
+    parser.add_argument('--stats', default=None, help="JSON report with ray counts and per-stage timings")
+    parser.add_argument('--tile-heatmap', default=None, help="PNG with the render time of every tile")
+    parser.add_argument('--denoise', action='store_true',
+                        help="filter the final image guided by first-hit albedo, normal and depth buffers")
+    parser.add_argument('--aov-samples', type=int, default=4, help="samples per pixel of the denoiser buffers")
+    parser.add_argument('--listen', default=None,
+                        help="HOST:PORT to serve tiles to render farm workers started with farm.py")
+    parser.add_argument('--local-workers', type=int, default=0, help="farm workers to start on this machine")
+    parser.add_argument('--worker-timeout', type=float, default=300.0,
+                        help="fail the farm render after this many seconds without any connected worker")
+    parser.add_argument('--stream', action='store_true',
+                        help="write bands of --tile-size rows straight to --out (.png or float32 .npy) without "
+                             "holding the frame in memory, for 16k and larger renders")
+    args = parser.parse_args(argv)
+    if args.resume and not args.checkpoint:
+        parser.error("--resume needs --checkpoint")
+    if args.listen:
+        host, _, port = args.listen.rpartition(':')
+        if not port.isdigit():
+            parser.error(f"--listen expects HOST:PORT, got {args.listen!r}")
+        args.listen = (host or '0.0.0.0', int(port))
+        if args.stats or args.tile_heatmap or args.denoise:
+            parser.error("--stats, --tile-heatmap and --denoise are not available on the render farm")
+    elif args.local_workers:
+        parser.error("--local-workers needs --listen")
+    if args.stream and (args.listen or args.checkpoint or args.progressive or args.denoise or args.heatmap or
+                        args.stats or args.tile_heatmap):
+        parser.error("--stream renders one fixed or adaptive pass: it takes none of --listen, --checkpoint, "
+                     "--progressive, --denoise, --heatmap, --stats and --tile-heatmap")
+    return args
+
+
+def main(argv: list | None = None):
+    args = parse_args(argv)
+    scene = load_scene(args.scene) if os.path.isfile(args.scene) else import_module(args.scene)
+    scene.camera.screen_size = Vector(args.width, args.height)
+    scene.skybox.bilinear = args.sky_bilinear
+    sequence = make_sequence(args.sequence, args.max_spp if args.adaptive else args.spp)
+    renderer = BatchRenderer(scene.objects, scene.lights, scene.camera, scene.skybox, scene.shadow_bias,
+                             args.max_reflections, sequence=sequence, min_throughput=args.min_throughput,
+                             roulette_depth=args.roulette_depth,
+                             light_samples=args.light_samples or getattr(scene, 'light_samples', 1))
+    if args.stats or args.tile_heatmap:
+        renderer.stats = RenderStats()
+    sampler = AdaptiveSampler(args.min_spp, args.max_spp, args.threshold) \
+        if args.adaptive and not args.progressive else None
+    out = args.out or f"file_{datetime.now().strftime('%d%m%Y%H%M%S')}.png"
+    if args.stream:
+        start = perf_counter()
+        samples, rays = render_stream(renderer, args.width, args.height, out, args.spp, args.seed,
+                                      args.tile_size, args.workers, sampler)
+        elapsed = perf_counter() - start
+        print(f"{out}: {args.width}x{args.height}, {samples / (args.width * args.height):.1f} spp in "
+              f"{elapsed:.2f} s, {rays} rays, {rays / elapsed:,.0f} rays/s")
+        return
+    if args.listen:
+        tile_renderer = Coordinator(renderer, args.width, args.height, args.tile_size, sampler, *args.listen,
+                                    local_workers=args.local_workers, worker_timeout=args.worker_timeout)
+        print(f"Serving tiles on {tile_renderer.address[0]}:{tile_renderer.address[1]}")
+    else:
+        tile_renderer = TileRenderer(renderer, args.width, args.height, args.tile_size, args.workers, sampler,
+                                     args.aov_samples if args.denoise else 0)
+
+    start = perf_counter()
+    try:
+        if args.checkpoint:
+            # Прогрессивный режим: spp проходов по 1 сэмплу, иначе один проход на spp сэмплов
+            checkpoint = Checkpoint(args.checkpoint, args.width, args.height, args.tile_size, args.resume,
+                                    args.flush_interval)
+            passes, samples = (args.spp, 1) if args.progressive else (1, args.spp)
+            try:
+                done = checkpoint.passes
+                resumed = done > 0 or checkpoint.done.any()
+                for _ in checkpoint.render(tile_renderer, samples, passes, args.seed, args.time_budget):
+                    if checkpoint.passes != done:
+                        done = checkpoint.passes
+                        Image.fromarray(to_rgb(checkpoint.image())).save(out)
+                image, counts = checkpoint.image(), checkpoint.counts.copy()
+                if args.denoise and resumed:
+                    # У тайлов прошлого запуска нет буферов денойзера: дешёвый проход одних AOV по всему кадру
+                    for _ in tile_renderer.render_aovs(checkpoint.seed):
+                        pass
+            finally:
+                checkpoint.close()
+        elif args.progressive:
+            progressive_renderer = ProgressiveRenderer(tile_renderer)
+            image = None
+            for image in progressive_renderer.render(args.spp, args.time_budget, args.seed):
+                Image.fromarray(to_rgb(image)).save(out)
+            counts = np.full((args.height, args.width), progressive_renderer.passes)
+        else:
+            for _ in tile_renderer.render(args.spp, args.seed):
+                pass
+            image, counts = tile_renderer.framebuffer.array.copy(), tile_renderer.framebuffer.counts.copy()
+        if args.denoise and image is not None:
+            # Дисперсия сэмплов есть только при фиксированном числе сэмплов за один проход, отрендеренный сейчас
+            framebuffer = tile_renderer.framebuffer
+            variance = framebuffer.variance \
+                if sampler is None and not args.progressive and not args.checkpoint and args.spp > 1 else None
+            image = denoise(image, framebuffer.albedo, framebuffer.normals, framebuffer.depth, variance)
+        if image is not None:
+            Image.fromarray(to_rgb(image)).save(out)
+    finally:
+        tile_renderer.close()
+    elapsed = perf_counter() - start
+
+    if args.heatmap:
+        Image.fromarray(heatmap(counts, int(counts.max()) or 1)).save(args.heatmap)
+    if args.stats:
+        tile_renderer.stats.save(args.stats, elapsed)
+    if args.tile_heatmap:
+        Image.fromarray(tile_renderer.stats.heatmap(args.width, args.height)).save(args.tile_heatmap)
+    print(f"{out}: {args.width}x{args.height}, {counts.mean():.1f} spp in {elapsed:.2f} s, "
+          f"{tile_renderer.rays} rays, {tile_renderer.rays / elapsed:,.0f} rays/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+from objects import Sphere, InfinityChessBoard
+from camera import Camera
+from skybox import Skybox
+from vector import Vector
+from light import Light
+from sequences import SobolSequence
+
+screen_size = Vector(1440, 850)
+shadow_bias = 0.0001
+max_reflections = 6
+# Путь обрывается при вкладе меньше min_throughput, после roulette_depth отражений - русской рулеткой
+min_throughput = 0.01
+roulette_depth = 2
+samples_per_pixel = 10
+# Сэмплы пикселя и апертуры: RandomSequence, StratifiedSequence(samples_per_pixel), HaltonSequence, SobolSequence
+sequence = SobolSequence()
+
+camera = Camera(Vector(0, 0, 5), screen_size, 60, focus_distance=15.0, aperture=0.5)
+skybox = Skybox("skybox.png")
+
+objects = [
+    Sphere(Vector(0, -2, -10), 2, Vector(1, 0, 0), Vector(1, 1, 1), Vector(0.1, 0.1, 0.1), 32),
+    Sphere(Vector(5,-2, -15), 2, Vector(0, 1, 0), Vector(1, 1, 1), Vector(0.1, 0.1, 0.1), 32),
+    Sphere(Vector(-5, 0, -15), 2, Vector(0, 0, 1), Vector(1, 1, 1), Vector(0.1, 0.1, 0.1), 32),
+    InfinityChessBoard(2, Vector(0, 0, 0), Vector(1, 1, 1))
+]
+
+light = Light(Vector(-1, 1, -1), 1, Vector(1, 1, 1), Vector(1, 1, 1), Vector(0.2, 0.2, 0.2))
+# Направленные Light и точечные PointLight(позиция, сила на расстоянии 1, цвета)
+lights = [light]
+# Теневых лучей на точку попадания: если источников больше, они выбираются пропорционально мощности
+light_samples = 1
@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+from functools import lru_cache
+from math import ceil, sqrt, floor
+
+import numpy as np
+
+# Измерения сэмпла: 0, 1 - сдвиг внутри пикселя, 2 - угол на апертуре камеры
+dimensions = 3
+mask = (1 << 64) - 1
+
+
+def mix(values: np.ndarray) -> np.ndarray:
+    # Финализатор splitmix64: соседние счётчики дают независимые 64 бита
+    values = values + np.uint64(0x9E3779B97F4A7C15)
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def mix_int(value: int) -> int:
+    value = (value + 0x9E3779B97F4A7C15) & mask
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & mask
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & mask
+    return value ^ (value >> 31)
+
+
+@lru_cache(maxsize=16)
+def seed_key(seed: int) -> np.uint64:
+    # seed может быть 128-битной энтропией SeedSequence, сворачиваем его в 64 бита
+    return np.random.SeedSequence(seed).generate_state(1, np.uint64)[0]
+
+
+def pixel_hash(key: np.uint64, xs: np.ndarray, ys: np.ndarray, counters: np.ndarray) -> np.ndarray:
+    # Счётчиковый генератор: значение зависит только от (seed, пиксель, счётчик), а не от порядка вызовов,
+    # поэтому кадр не зависит от разбиения на тайлы и процессы
+    values = mix(np.floor(xs).astype(np.int64).astype(np.uint64) ^ key)
+    values = mix(values ^ np.floor(ys).astype(np.int64).astype(np.uint64))
+    return mix(values ^ counters.astype(np.uint64))
+
+
+def pixel_hash_int(key: int, x: float, y: float, counter: int) -> int:
+    # То же, что pixel_hash, для одного сэмпла в скалярном трассировщике
+    return mix_int(mix_int(mix_int((floor(x) & mask) ^ key) ^ (floor(y) & mask)) ^ counter)
+
+
+def path_keys(seed: int, xs: np.ndarray, ys: np.ndarray, indices: np.ndarray) -> np.ndarray:
+    # Ключ пути сэмпла для случайных решений интегратора; старший бит отделяет их от счётчиков последовательностей
+    return pixel_hash(seed_key(seed), xs, ys, indices.astype(np.uint64) | np.uint64(1 << 63))
+
+
+def path_key_int(seed: int, x: float, y: float, index: int) -> int:
+    return pixel_hash_int(int(seed_key(seed)), x, y, index | 1 << 63)
+
+
+def roulette(keys: np.ndarray, depth: int) -> np.ndarray:
+    # Равномерное число в [0, 1) для решения на глубине depth
+    return to_unit(mix(keys ^ np.uint64(depth)))
+
+
+def roulette_int(key: int, depth: int) -> float:
+    return (mix_int(key ^ depth) >> 11) * 2.0 ** -53
+
+
+def light_sample(keys: np.ndarray, depth: int, sample: int) -> np.ndarray:
+    # Число в [0, 1) для выбора источника света; отдельный бит отделяет его от рулетки на той же глубине
+    return to_unit(mix(keys ^ np.uint64(1 << 62 | sample << 16 | depth)))
+
+
+def light_sample_int(key: int, depth: int, sample: int) -> float:
+    return (mix_int(key ^ (1 << 62 | sample << 16 | depth)) >> 11) * 2.0 ** -53
+
+
+def to_unit(values: np.ndarray) -> np.ndarray:
+    return (values >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+
+def radical_inverse_int(index: int, base: int) -> float:
+    result, factor = 0.0, 1 / base
+    while index:
+        result += index % base * factor
+        index //= base
+        factor /= base
+    return result
+
+
+def radical_inverse(indices: np.ndarray, base: int) -> np.ndarray:
+    indices = indices.astype(np.int64)
+    result = np.zeros(indices.size)
+    factor = 1 / base
+    while indices.any():
+        result += indices % base * factor
+        indices //= base
+        factor /= base
+    return result
+
+
+def sobol_directions(s: int, a: int, m: list) -> np.ndarray:
+    # Направляющие числа Соболя для примитивного многочлена степени s с коэффициентами a (Joe, Kuo)
+    v = [m[k] << (31 - k) for k in range(s)]
+    for k in range(s, 32):
+        value = v[k - s] ^ (v[k - s] >> s)
+        for j in range(1, s):
+            value ^= ((a >> (s - 1 - j)) & 1) * v[k - j]
+        v.append(value)
+    return np.array(v, dtype=np.uint64)
+
+
+class RandomSequence:
+    # Независимые равномерные числа, но тоже счётчиковые
+    __slots__ = ()
+
+    def __repr__(self) -> str:
+        return "RandomSequence()"
+
+    def sample(self, xs: np.ndarray, ys: np.ndarray, indices: np.ndarray, seed: int) -> np.ndarray:
+        key = seed_key(seed)
+        counters = indices.astype(np.uint64) * np.uint64(dimensions)
+        return np.stack([to_unit(pixel_hash(key, xs, ys, counters + np.uint64(d))) for d in range(dimensions)])
+
+    def point(self, x: float, y: float, index: int, seed: int) -> tuple:
+        key = int(seed_key(seed))
+        return tuple((pixel_hash_int(key, x, y, index * dimensions + d) >> 11) * 2.0 ** -53 for d in range(dimensions))
+
+
+class StratifiedSequence:
+    # Сетка m x m внутри пикселя и samples слоёв апертуры, в каждой ячейке случайная точка
+    __slots__ = ('samples', 'grid')
+
+    def __init__(self, samples: int):
+        self.samples = max(samples, 1)
+        self.grid = ceil(sqrt(self.samples))
+
+    def __repr__(self) -> str:
+        return f"StratifiedSequence(samples: {self.samples}, grid: {self.grid}x{self.grid})"
+
+    def sample(self, xs: np.ndarray, ys: np.ndarray, indices: np.ndarray, seed: int) -> np.ndarray:
+        key = seed_key(seed)
+        counters = indices.astype(np.uint64) * np.uint64(dimensions)
+        jitter = [to_unit(pixel_hash(key, xs, ys, counters + np.uint64(d))) for d in range(dimensions)]
+        # Сдвиг слоёв на пиксель: иначе у всех пикселей первый сэмпл попадал бы в одну и ту же ячейку
+        shift = pixel_hash(key, xs, ys, np.full(indices.size, 0xFFFFFFFF, dtype=np.uint64))
+        cells = (indices.astype(np.uint64) + shift) % np.uint64(self.grid * self.grid)
+        layers = (indices.astype(np.uint64) + (shift >> np.uint64(32))) % np.uint64(self.samples)
+        return np.stack(((cells % np.uint64(self.grid) + jitter[0]) / self.grid,
+                         (cells // np.uint64(self.grid) + jitter[1]) / self.grid,
+                         (layers + jitter[2]) / self.samples))
+
+    def point(self, x: float, y: float, index: int, seed: int) -> tuple:
+        key = int(seed_key(seed))
+        jitter = [(pixel_hash_int(key, x, y, index * dimensions + d) >> 11) * 2.0 ** -53 for d in range(dimensions)]
+        shift = pixel_hash_int(key, x, y, 0xFFFFFFFF)
+        cell = (index + shift) % (self.grid * self.grid)
+        layer = (index + (shift >> 32)) % self.samples
+        return ((cell % self.grid + jitter[0]) / self.grid, (cell // self.grid + jitter[1]) / self.grid,
+                (layer + jitter[2]) / self.samples)
+
+
+class HaltonSequence:
+    # Основания 2, 3, 5 и случайный циклический сдвиг (Cranley-Patterson) на каждый пиксель
+    __slots__ = ('bases',)
+
+    def __init__(self, bases: tuple = (2, 3, 5)):
+        self.bases = bases
+
+    def __repr__(self) -> str:
+        return f"HaltonSequence(bases: {self.bases})"
+
+    def sample(self, xs: np.ndarray, ys: np.ndarray, indices: np.ndarray, seed: int) -> np.ndarray:
+        key = seed_key(seed)
+        points = []
+        for d, base in enumerate(self.bases):
+            shift = to_unit(pixel_hash(key, xs, ys, np.full(indices.size, d, dtype=np.uint64)))
+            points.append((radical_inverse(indices, base) + shift) % 1)
+        return np.stack(points)
+
+    def point(self, x: float, y: float, index: int, seed: int) -> tuple:
+        key = int(seed_key(seed))
+        return tuple((radical_inverse_int(index, base) + (pixel_hash_int(key, x, y, d) >> 11) * 2.0 ** -53) % 1
+                     for d, base in enumerate(self.bases))
+
+
+class SobolSequence:
+    # Первые три измерения Соболя, на каждый пиксель свой случайный цифровой сдвиг (XOR):
+    # он сохраняет стратификацию последовательности по двоичным ячейкам
+    __slots__ = ('directions', 'columns')
+
+    def __init__(self):
+        self.directions = np.stack((np.array([1 << (31 - k) for k in range(32)], dtype=np.uint64),
+                                    sobol_directions(1, 0, [1]),
+                                    sobol_directions(2, 1, [1, 3])))
+        self.columns = self.directions.tolist()
+
+    def __repr__(self) -> str:
+        return "SobolSequence()"
+
+    def sample(self, xs: np.ndarray, ys: np.ndarray, indices: np.ndarray, seed: int) -> np.ndarray:
+        key = seed_key(seed)
+        indices = indices.astype(np.uint64)
+        points = np.zeros((dimensions, indices.size), dtype=np.uint64)
+        bit = 0
+        while (indices >> np.uint64(bit)).any():
+            has = ((indices >> np.uint64(bit)) & np.uint64(1)).astype(bool)
+            points[:, has] ^= self.directions[:, bit:bit + 1]
+            bit += 1
+        for d in range(dimensions):
+            points[d] ^= pixel_hash(key, xs, ys, np.full(indices.size, d, dtype=np.uint64)) >> np.uint64(32)
+        return points.astype(np.float64) * 2.0 ** -32
+
+    def point(self, x: float, y: float, index: int, seed: int) -> tuple:
+        key = int(seed_key(seed))
+        point = []
+        for d, directions in enumerate(self.columns):
+            value, bit = pixel_hash_int(key, x, y, d) >> 32, 0
+            while index >> bit:
+                if index >> bit & 1:
+                    value ^= directions[bit]
+                bit += 1
+            point.append(value * 2.0 ** -32)
+        return tuple(point)
+
+
+SEQUENCES = {
+    'random': RandomSequence,
+    'stratified': StratifiedSequence,
+    'halton': HaltonSequence,
+    'sobol': SobolSequence,
+}
+
+
+def make_sequence(name: str, samples: int):
+    if name == 'stratified':
+        return StratifiedSequence(samples)
+    return SEQUENCES[name]()
@@ -0,0 +1,356 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from queue import Queue
+from threading import Lock, Thread
+
+from PIL import Image
+
+from batch import BatchRenderer, to_rgb
+from camera import Camera
+from checkpoint import Checkpoint
+from loader import load_scene, vector
+from sequences import SEQUENCES, make_sequence
+from tiles import TileRenderer
+from vector import Vector
+
+# Модули, от которых зависят пиксели: их исходники входят в ключ кеша вместо номера версии
+RENDERER_MODULES = ('adaptive', 'batch', 'bvh', 'camera', 'checkpoint', 'light', 'loader', 'mesh', 'objects',
+                    'sequences', 'skybox', 'tiles', 'vector')
+CAMERA_FIELDS = ('position', 'fov', 'focus_distance', 'aperture')
+tile_size = 32
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def renderer_version() -> str:
+    folder = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256()
+    for name in RENDERER_MODULES:
+        digest.update(file_hash(os.path.join(folder, f"{name}.py")).encode())
+    return digest.hexdigest()
+
+
+def asset_paths(value, folder: str) -> list:
+    # Строки описания, указывающие на существующие файлы: скайбокс, .obj, .npy и наборы сфер
+    if isinstance(value, dict):
+        return [path for item in value.values() for path in asset_paths(item, folder)]
+    if isinstance(value, list):
+        return [path for item in value for path in asset_paths(item, folder)]
+    if isinstance(value, str) and os.path.isfile(os.path.join(folder, value)):
+        return [value]
+    return []
+
+
+class Job:
+    __slots__ = ('id', 'request', 'key', 'status', 'spp', 'image', 'error', 'fetched')
+
+    def __init__(self, id: int, request: dict, key: str):
+        self.id = id
+        self.request = request
+        self.key = key
+        # queued -> running -> done | failed
+        self.status = 'queued'
+        # Сэмплов в готовом кадре: из кеша может прийти кадр с большим числом, чем просили
+        self.spp = 0
+        self.image = None
+        self.error = None
+        # Пока готовый кадр не забрали, его запись не вытесняется из кеша
+        self.fetched = False
+
+    def __repr__(self) -> str:
+        return f"Job(id: {self.id}, status: {self.status}, spp: {self.spp})"
+
+    def report(self) -> dict:
+        report = {'id': self.id, 'key': self.key, 'status': self.status, 'requested_spp': self.request['spp'],
+                  'spp': self.spp}
+        if self.error is not None:
+            report['error'] = self.error
+        return report
+
+
+class RenderService:
+    # Очередь рендеров с кешем по содержимому. Ключ - хеш описания сцены, файлов, на которые оно ссылается,
+    # камеры, размера кадра, seed, последовательности и исходников рендерера; spp в ключ не входит. Запись кеша -
+    # контрольная точка с суммой сэмплов (проходы по 1 сэмплу на пиксель) и PNG каждого готового spp, поэтому
+    # запрос с большим spp продолжает накопление с того места, где остановился прошлый. Записи вытесняются
+    # целиком по давности использования (mtime .json), пока размер кеша больше max_bytes
+    __slots__ = ('root', 'cache', 'max_bytes', 'workers', 'version', 'jobs', 'ids', 'queue', 'lock', 'hashes',
+                 'active', 'thread')
+
+    def __init__(self, root: str, cache: str, max_bytes: int, workers: int = 1):
+        self.root = os.path.realpath(root)
+        self.cache = cache
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.version = renderer_version()
+        self.jobs = {}
+        self.ids = count(1)
+        self.queue = Queue()
+        self.lock = Lock()
+        # Хеши файлов сцены по (путь, размер, mtime): большие файлы не перечитываются на каждый запрос
+        self.hashes = {}
+        # Ключ, который сейчас рендерится: его не вытесняем
+        self.active = None
+        os.makedirs(cache, exist_ok=True)
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __repr__(self) -> str:
+        return f"RenderService(cache: {self.cache}, jobs: {len(self.jobs)}, version: {self.version[:12]})"
+
+    def resolve(self, path: str) -> str:
+        # Сцены только из root: сервис не должен читать произвольные файлы машины
+        full = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath((full, self.root)) != self.root or not os.path.isfile(full):
+            raise ValueError(f"Scene {path!r} is not a file under {self.root}")
+        return full
+
+    def hash_file(self, path: str) -> str:
+        stat = os.stat(path)
+        signature = (path, stat.st_size, stat.st_mtime_ns)
+        if signature not in self.hashes:
+            self.hashes[signature] = file_hash(path)
+        return self.hashes[signature]
+
+    def normalize(self, request: dict) -> dict:
+        request = dict(request)
+        if not isinstance(request.get('scene'), str):
+            raise ValueError("'scene' must be a path to a JSON scene")
+        for name in ('width', 'height', 'spp'):
+            if not isinstance(request.get(name), int) or request[name] < 1:
+                raise ValueError(f"{name!r} must be a positive integer")
+        request.setdefault('seed', 0)
+        request.setdefault('sequence', 'sobol')
+        request.setdefault('camera', {})
+        if request['sequence'] not in SEQUENCES:
+            raise ValueError(f"Unknown sequence {request['sequence']!r}")
+        if not isinstance(request['seed'], int) or request['seed'] < 0:
+            raise ValueError("'seed' must be a non-negative integer")
+        unknown = set(request['camera']) - set(CAMERA_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown camera fields: {', '.join(sorted(unknown))}")
+        return request
+
+    def cache_key(self, request: dict) -> str:
+        path = self.resolve(request['scene'])
+        with open(path) as file:
+            description = json.load(file)
+        folder = os.path.dirname(path)
+        fields = {
+            'scene': description,
+            'assets': {name: self.hash_file(os.path.join(folder, name)) for name in asset_paths(description, folder)},
+            'camera': request['camera'],
+            'size': [request['width'], request['height']],
+            'seed': request['seed'],
+            'sequence': request['sequence'],
+            'version': self.version,
+        }
+        if request['sequence'] == 'stratified':
+            # Страты зависят от полного числа сэмплов: накопление с меньшим spp не продолжить
+            fields['spp'] = request['spp']
+        return hashlib.sha256(json.dumps(fields, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+    def entry(self, key: str, suffix: str) -> str:
+        return os.path.join(self.cache, f"{key}{suffix}")
+
+    def cached(self, key: str, spp: int) -> tuple:
+        # (spp, PNG) готового кадра: ровно spp, если он был, иначе лучший из более долгих; None - рендерить
+        path = self.entry(key, '.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as file:
+            frames = json.load(file)['frames']
+        frames = [frame for frame in frames if frame >= spp]
+        if not frames:
+            return None
+        frame = spp if spp in frames else max(frames)
+        os.utime(path)
+        return frame, self.entry(key, f"-{frame}.png")
+
+    def submit(self, request: dict) -> Job:
+        request = self.normalize(request)
+        job = Job(next(self.ids), request, self.cache_key(request))
+        with self.lock:
+            self.jobs[job.id] = job
+            hit = self.cached(job.key, request['spp'])
+            if hit is not None:
+                job.spp, job.image = hit
+                job.status = 'done'
+                return job
+        self.queue.put(job)
+        return job
+
+    def status(self, id: int) -> Job:
+        if id not in self.jobs:
+            raise KeyError(f"Unknown job {id}")
+        return self.jobs[id]
+
+    def fetch(self, id: int) -> bytes:
+        job = self.status(id)
+        if job.status != 'done':
+            raise ValueError(f"Job {id} is {job.status}")
+        with open(job.image, 'rb') as file:
+            data = file.read()
+        job.fetched = True
+        return data
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            with self.lock:
+                # Такой же запрос мог быть отрендерен, пока этот ждал в очереди
+                hit = self.cached(job.key, job.request['spp'])
+                if hit is not None:
+                    job.spp, job.image = hit
+                    job.status = 'done'
+                    continue
+                job.status = 'running'
+                self.active = job.key
+            try:
+                self.render(job)
+                job.status = 'done'
+            except Exception as error:
+                job.status, job.error = 'failed', f"{type(error).__name__}: {error}"
+            with self.lock:
+                # Вытеснение до снятия active: только что отрендеренная запись защищена, даже если она одна
+                # больше max_bytes
+                self.evict()
+                self.active = None
+
+    def render(self, job: Job):
+        request = job.request
+        width, height, spp = request['width'], request['height'], request['spp']
+        scene = load_scene(self.resolve(request['scene']))
+        camera = {'position': [scene.camera.position.x, scene.camera.position.y, scene.camera.position.z],
+                  'fov': scene.camera.fov, 'focus_distance': scene.camera.focus_distance,
+                  'aperture': scene.camera.aperture, **request['camera']}
+        camera = Camera(vector(camera['position']), Vector(width, height), camera['fov'], camera['focus_distance'],
+                        camera['aperture'])
+        renderer = BatchRenderer(scene.objects, scene.lights, camera, scene.skybox, scene.shadow_bias,
+                                 scene.max_reflections, sequence=make_sequence(request['sequence'], spp),
+                                 min_throughput=scene.min_throughput, roulette_depth=scene.roulette_depth,
+                                 light_samples=scene.light_samples)
+        tile_renderer = TileRenderer(renderer, width, height, tile_size, self.workers)
+        checkpoint = Checkpoint(self.entry(job.key, '.ckpt'), width, height, tile_size, resume=True)
+        try:
+            for _ in checkpoint.render(tile_renderer, 1, spp, request['seed']):
+                job.spp = checkpoint.passes
+            image = checkpoint.image()
+            job.spp = checkpoint.passes
+        finally:
+            checkpoint.close()
+            tile_renderer.close()
+        job.image = self.entry(job.key, f"-{job.spp}.png")
+        Image.fromarray(to_rgb(image)).save(job.image)
+        path = self.entry(job.key, '.json')
+        frames = []
+        if os.path.exists(path):
+            with open(path) as file:
+                frames = json.load(file)['frames']
+        with open(path, 'w') as file:
+            json.dump({'request': request, 'frames': sorted(set(frames) | {job.spp})}, file)
+
+    def evict(self):
+        # Под self.lock: удаляем записи с самым старым использованием, пока кеш больше max_bytes
+        entries = {}
+        for name in os.listdir(self.cache):
+            key = name[:64]
+            size, used = entries.get(key, (0, 0.0))
+            stat = os.stat(os.path.join(self.cache, name))
+            entries[key] = (size + stat.st_size, max(used, stat.st_mtime) if name.endswith('.json') else used)
+        total = sum(size for size, _ in entries.values())
+        # Рендерящийся ключ и кадры готовых, но ещё не забранных заданий остаются, даже если кеш больше max_bytes
+        protected = {self.active} | {job.key for job in self.jobs.values() if job.status == 'done' and not job.fetched}
+        for key, (size, _) in sorted(entries.items(), key=lambda item: item[1][1]):
+            if total <= self.max_bytes:
+                break
+            if key in protected:
+                continue
+            for name in os.listdir(self.cache):
+                if name.startswith(key):
+                    os.remove(os.path.join(self.cache, name))
+            total -= size
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    # POST /jobs - JSON запроса, GET /jobs/<id> - состояние, GET /jobs/<id>/image - PNG готового кадра
+    def send_json(self, code: int, value: dict):
+        body = json.dumps(value).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            return self.send_json(404, {'error': f"Unknown path {self.path}"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            job = self.server.service.submit(request)
+        except (ValueError, TypeError, AttributeError) as error:
+            return self.send_json(400, {'error': str(error)})
+        self.send_json(200 if job.status == 'done' else 202, job.report())
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) not in (2, 3) or parts[0] != 'jobs' or not parts[1].isdigit() or parts[2:] not in ([], ['image']):
+            return self.send_json(404, {'error': f"Unknown path {self.path}"})
+        service = self.server.service
+        try:
+            job = service.status(int(parts[1]))
+            if len(parts) == 2:
+                return self.send_json(200, job.report())
+            image = service.fetch(job.id)
+        except KeyError as error:
+            return self.send_json(404, {'error': str(error.args[0])})
+        except ValueError as error:
+            return self.send_json(409, {'error': str(error)})
+        except FileNotFoundError:
+            return self.send_json(410, {'error': f"Job {job.id} was evicted from the cache"})
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(image)))
+        self.end_headers()
+        self.wfile.write(image)
+
+
+def parse_args(argv: list | None = None):
+    parser = ArgumentParser(description="Local lab8 render service with a content-addressed frame cache")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8008)
+    parser.add_argument('--root', default='.', help="folder the scene paths of requests are resolved against")
+    parser.add_argument('--cache', default='render_cache')
+    parser.add_argument('--cache-size', type=float, default=2048, help="cache size cap in MB")
+    parser.add_argument('--workers', type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def main(argv: list | None = None):
+    args = parse_args(argv)
+    service = RenderService(args.root, args.cache, int(args.cache_size * (1 << 20)), args.workers)
+    server = ThreadingHTTPServer((args.host, args.port), ServiceHandler)
+    server.service = service
+    print(f"{service} on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,113 @@
+from __future__ import annotations
+
+import os
+import tempfile
+from hashlib import sha256
+from io import BytesIO
 from math import atan2, asin, pi
-from numpy import asarray
+
+import numpy as np
 from PIL import Image
 
 from vector import Vector
 
+# Декодированные панорамы хранятся рядом с исходником: <папка>/.cache/<имя>.<хеш>.npy
+cache_dir = '.cache'
+# Панорамы, присланные по сети, у которых нет своей папки
+remote_cache_dir = os.path.join(tempfile.gettempdir(), 'lab8-skybox')
+
+
+def load_equirectangular(path: str) -> np.ndarray:
+    # float32 (h, w, 3) в [0, 1]; PNG декодируется только при первом запуске для данного содержимого файла
+    with open(path, 'rb') as file:
+        data = file.read()
+    return decode_equirectangular(data, os.path.join(os.path.dirname(path), cache_dir), os.path.basename(path))
+
+
+def decode_equirectangular(data: bytes, directory: str, name: str) -> np.ndarray:
+    digest = sha256(data).hexdigest()[:16]
+    cache_path = os.path.join(directory, f"{name}.{digest}.npy")
+    if os.path.exists(cache_path):
+        # Обычный ndarray поверх отображения: индексирование memmap заметно медленнее
+        return np.asarray(np.load(cache_path, mmap_mode='r'))
+
+    array = np.asarray(Image.open(BytesIO(data)).convert('RGB'), dtype=np.float32) / 255
+    try:
+        os.makedirs(directory, exist_ok=True)
+        # Пишем во временный файл и переименовываем, чтобы параллельный запуск не прочитал половину
+        temporary = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as file:
+            np.save(file, array)
+        os.replace(temporary, cache_path)
+    except OSError:
+        return array
+    return np.asarray(np.load(cache_path, mmap_mode='r'))
+
 
 class Skybox:
-    __slots__ = ('path', 'array', 'size')
+    __slots__ = ('path', 'array', 'size', 'bilinear')
 
-    def __init__(self, path: str):
+    def __init__(self, path: str, bilinear: bool = False):
         self.path = path
-        image = Image.open(self.path)
-        self.array = asarray(image)
-        self.size = image.size
+        self.array = load_equirectangular(path)
+        self.size = (self.array.shape[1], self.array.shape[0])
+        self.bilinear = bilinear
+
+    def __repr__(self) -> str:
+        return f"Skybox(path: {self.path}, size: {self.size}, bilinear: {self.bilinear})"
+
+    def __reduce__(self):
+        # В процессы-воркеры передаётся только путь: они открывают тот же кеш через mmap
+        return Skybox, (self.path, self.bilinear)
+
+    def portable(self) -> tuple:
+        # Для другой машины путь бесполезен: вместо него сам PNG и его sha256, см. farm.ScenePickler
+        with open(self.path, 'rb') as file:
+            data = file.read()
+        return Skybox.from_bytes, (os.path.basename(self.path), data, sha256(data).hexdigest(), self.bilinear)
+
+    @classmethod
+    def from_bytes(cls, name: str, data: bytes, digest: str, bilinear: bool = False) -> Skybox:
+        # Декодированная панорама кешируется по хешу содержимого, так что повторный запуск воркера её не декодирует
+        if sha256(data).hexdigest() != digest:
+            raise ValueError(f"Skybox {name} does not match its sha256 {digest}")
+        skybox = cls.__new__(cls)
+        skybox.path = name
+        skybox.array = decode_equirectangular(data, remote_cache_dir, name)
+        skybox.size = (skybox.array.shape[1], skybox.array.shape[0])
+        skybox.bilinear = bilinear
+        return skybox
 
     def get_image_coords(self, normal: Vector) -> Vector:
+        if self.bilinear:
+            color = self.get_image_colors(np.array([[normal.x], [normal.y], [normal.z]]))[:, 0].tolist()
+            return Vector(*color)
         u = 0.5 + atan2(normal.z, normal.x) / (2 * pi)
-        v = 0.5 + asin(normal.y) / pi
-        image_position = (int(u * self.size[0]), int(v * self.size[1]))
-        color = self.array[image_position[1]][image_position[0]]
-        return Vector(color[0], color[1], color[2]) / 255
\ No newline at end of file
+        v = 0.5 + asin(min(max(normal.y, -1), 1)) / pi
+        x = min(int(u * self.size[0]), self.size[0] - 1)
+        y = min(int(v * self.size[1]), self.size[1] - 1)
+        r, g, b = self.array[y, x].tolist()
+        return Vector(r, g, b)
+
+    def get_image_colors(self, directions: np.ndarray) -> np.ndarray:
+        # directions (3, n) -> цвета (3, n)
+        width, height = self.size
+        u = 0.5 + np.arctan2(directions[2], directions[0]) / (2 * pi)
+        v = 0.5 + np.arcsin(np.clip(directions[1], -1, 1)) / pi
+        if not self.bilinear:
+            xs = np.minimum((u * width).astype(np.int64), width - 1)
+            ys = np.minimum((v * height).astype(np.int64), height - 1)
+            return self.array[ys, xs].T.astype(np.float64)
+
+        # Центры пикселей в (i + 0.5); по долготе панорама замкнута, по широте край повторяется
+        x = u * width - 0.5
+        y = np.clip(v * height - 0.5, 0, height - 1)
+        x0, y0 = np.floor(x), np.floor(y)
+        fx, fy = (x - x0)[:, None], (y - y0)[:, None]
+        x0 = x0.astype(np.int64) % width
+        x1 = (x0 + 1) % width
+        y0 = y0.astype(np.int64)
+        y1 = np.minimum(y0 + 1, height - 1)
+        top = self.array[y0, x0] * (1 - fx) + self.array[y0, x1] * fx
+        bottom = self.array[y1, x0] * (1 - fx) + self.array[y1, x1] * fx
+        return (top * (1 - fy) + bottom * fy).T
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import json
+
+import numpy as np
+
+from adaptive import heatmap
+
+# Счётчики и этапы батч-рендерера. Сбор включается присваиванием renderer.stats = RenderStats(),
+# по умолчанию stats = None и в горячих путях остаётся только проверка на None
+COUNTERS = ('primary_rays', 'reflection_rays', 'shadow_rays', 'hits', 'misses', 'shadow_hits', 'sphere_tests',
+            'plane_tests', 'mesh_queries', 'sky_lookups')
+STAGES = ('primary', 'intersect', 'shade', 'shadow', 'sky')
+
+
+class RenderStats:
+    __slots__ = ('counters', 'stages', 'tiles')
+
+    def __init__(self):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        # Секунды по этапам; shade не включает shadow
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        # Время рендера каждого тайла (x0, y0, x1, y1), по всем проходам
+        self.tiles = {}
+
+    def __repr__(self) -> str:
+        return f"RenderStats(rays: {self.rays()}, tiles: {len(self.tiles)})"
+
+    def rays(self) -> int:
+        return self.counters['primary_rays'] + self.counters['reflection_rays'] + self.counters['shadow_rays']
+
+    def add_tile(self, tile: tuple, seconds: float):
+        self.tiles[tile] = self.tiles.get(tile, 0.0) + seconds
+
+    def take(self) -> RenderStats:
+        # Накопленное с прошлого вызова; так воркер отдаёт статистику тайла вместе с результатом
+        taken = RenderStats()
+        taken.counters, taken.stages, taken.tiles = self.counters, self.stages, self.tiles
+        self.__init__()
+        return taken
+
+    def merge(self, other: RenderStats):
+        for name, value in other.counters.items():
+            self.counters[name] += value
+        for name, value in other.stages.items():
+            self.stages[name] += value
+        for tile, seconds in other.tiles.items():
+            self.add_tile(tile, seconds)
+
+    def report(self, elapsed: float | None = None) -> dict:
+        counters = self.counters
+        queries = counters['hits'] + counters['misses']
+        paths = counters['primary_rays']
+        report = {
+            'rays': {'primary': counters['primary_rays'], 'reflection': counters['reflection_rays'],
+                     'shadow': counters['shadow_rays'], 'total': self.rays()},
+            'tests': {'sphere': counters['sphere_tests'], 'plane': counters['plane_tests'],
+                      'mesh': counters['mesh_queries']},
+            'hits': counters['hits'],
+            'misses': counters['misses'],
+            'hit_rate': counters['hits'] / queries if queries else 0.0,
+            'shadow_hits': counters['shadow_hits'],
+            'sky_lookups': counters['sky_lookups'],
+            # Отражений на путь: каждый путь начинается одним первичным лучом
+            'average_depth': counters['reflection_rays'] / paths if paths else 0.0,
+            'stages': self.stages,
+            'tiles': [{'tile': list(tile), 'seconds': seconds} for tile, seconds in sorted(self.tiles.items())],
+        }
+        if elapsed is not None:
+            report['elapsed'] = elapsed
+            report['rays_per_second'] = self.rays() / elapsed if elapsed > 0 else 0.0
+        return report
+
+    def save(self, path: str, elapsed: float | None = None):
+        with open(path, 'w') as file:
+            json.dump(self.report(elapsed), file, indent=2)
+
+    def tile_costs(self, width: int, height: int) -> np.ndarray:
+        # Секунды на пиксель, одинаковые внутри тайла
+        costs = np.zeros((height, width))
+        for (x0, y0, x1, y1), seconds in self.tiles.items():
+            costs[y0:y1, x0:x1] = seconds / ((x1 - x0) * (y1 - y0))
+        return costs
+
+    def heatmap(self, width: int, height: int) -> np.ndarray:
+        costs = self.tile_costs(width, height)
+        return heatmap(costs, costs.max() or 1)
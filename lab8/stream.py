@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import struct
+import zlib
+from collections import deque
+from multiprocessing import get_context
+
+import numpy as np
+
+from batch import BatchRenderer, to_rgb
+from adaptive import AdaptiveSampler
+from tiles import render_colors
+
+# Кадры больше памяти: полосы по tile_size строк рендерятся тайлами и сразу дописываются в файл.
+# В памяти только полосы в работе, поэтому пик RSS зависит от ширины кадра и размера тайла, а не от высоты
+
+
+class PNGWriter:
+    # 8-битный RGB PNG, сжимаемый построчно: IDAT-чанки пишутся по мере готовности полос
+    __slots__ = ('file', 'width', 'height', 'rows', 'compressor')
+
+    def __init__(self, path: str, width: int, height: int):
+        self.file = open(path, 'wb')
+        self.width = width
+        self.height = height
+        self.rows = 0
+        self.compressor = zlib.compressobj(6)
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self.chunk(b'IHDR', struct.pack('!IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def __repr__(self) -> str:
+        return f"PNGWriter(size: {self.width}x{self.height}, rows: {self.rows})"
+
+    def chunk(self, kind: bytes, data: bytes):
+        self.file.write(struct.pack('!I', len(data)) + kind)
+        self.file.write(data)
+        self.file.write(struct.pack('!I', zlib.crc32(data, zlib.crc32(kind))))
+
+    def write(self, colors: np.ndarray):
+        # Строки (rows, width, 3) в линейном цвете; перед каждой строкой байт фильтра 0 (без фильтра)
+        rgb = to_rgb(colors).reshape(colors.shape[0], -1)
+        data = self.compressor.compress(np.hstack((np.zeros((rgb.shape[0], 1), dtype=np.uint8), rgb)).tobytes())
+        if data:
+            self.chunk(b'IDAT', data)
+        self.rows += colors.shape[0]
+
+    def close(self):
+        if self.rows != self.height:
+            self.file.close()
+            raise ValueError(f"PNG has {self.rows} of {self.height} rows")
+        self.chunk(b'IDAT', self.compressor.flush())
+        self.chunk(b'IEND', b'')
+        self.file.close()
+
+
+class NPYWriter:
+    # float32 (height, width, 3) в .npy: строки C-порядка идут подряд, полосы дописываются в конец файла.
+    # Читается np.load(path, mmap_mode='r') без загрузки кадра целиком
+    __slots__ = ('file', 'width', 'height', 'rows')
+
+    def __init__(self, path: str, width: int, height: int):
+        self.file = open(path, 'wb')
+        self.width = width
+        self.height = height
+        self.rows = 0
+        np.lib.format.write_array_header_1_0(self.file, {'descr': '<f4', 'fortran_order': False,
+                                                         'shape': (height, width, 3)})
+
+    def __repr__(self) -> str:
+        return f"NPYWriter(size: {self.width}x{self.height}, rows: {self.rows})"
+
+    def write(self, colors: np.ndarray):
+        self.file.write(np.ascontiguousarray(colors, dtype='<f4').tobytes())
+        self.rows += colors.shape[0]
+
+    def close(self):
+        self.file.close()
+        if self.rows != self.height:
+            raise ValueError(f"NPY has {self.rows} of {self.height} rows")
+
+
+def make_writer(path: str, width: int, height: int) -> PNGWriter | NPYWriter:
+    return NPYWriter(path, width, height) if path.endswith('.npy') else PNGWriter(path, width, height)
+
+
+_worker = {}
+
+
+def _init_worker(renderer: BatchRenderer, sampler: AdaptiveSampler | None):
+    _worker['renderer'] = renderer
+    _worker['sampler'] = sampler
+
+
+def _render_tile(job: tuple) -> tuple:
+    tile, samples, seed = job
+    renderer = _worker['renderer']
+    rays = renderer.rays
+    colors, counts = render_colors(renderer, _worker['sampler'], tile, samples, seed, 0)
+    return colors, int(counts.sum()), renderer.rays - rays
+
+
+def render_stream(renderer: BatchRenderer, width: int, height: int, path: str, samples: int, seed: int | None = None,
+                  tile_size: int = 64, workers: int = 1, sampler: AdaptiveSampler | None = None,
+                  lookahead: int = 2):
+    # Полосы отдаются по порядку сверху вниз; воркеры заняты тайлами до lookahead полос вперёд.
+    # Возвращает (сумма сэмплов, лучей); сэмплы те же, что у TileRenderer с тем же seed
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    writer = make_writer(path, width, height)
+    bands = [(y, min(y + tile_size, height)) for y in range(0, height, tile_size)]
+    jobs = ([((x, y0, min(x + tile_size, width), y1), samples, seed) for x in range(0, width, tile_size)]
+            for y0, y1 in bands)
+    pool = get_context('spawn').Pool(workers, initializer=_init_worker, initargs=(renderer, sampler)) \
+        if workers > 1 else None
+    pending = deque()
+    total_samples = total_rays = 0
+    try:
+        for (y0, y1), band in zip(bands, jobs):
+            if pool is None:
+                _init_worker(renderer, sampler)
+                pending.append(list(map(_render_tile, band)))
+            else:
+                pending.append([pool.apply_async(_render_tile, (job,)) for job in band])
+            while len(pending) > lookahead or (pending and y1 == height):
+                results = [result if pool is None else result.get() for result in pending.popleft()]
+                writer.write(np.concatenate([colors for colors, _, _ in results], axis=1))
+                total_samples += sum(count for _, count, _ in results)
+                total_rays += sum(rays for _, _, rays in results)
+        writer.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if not writer.file.closed:
+            writer.file.close()
+    return total_samples, total_rays
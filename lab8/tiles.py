@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+from multiprocessing import get_context, cpu_count, shared_memory
+from time import perf_counter
+
+import numpy as np
+
+from batch import BatchRenderer
+from adaptive import AdaptiveSampler
+from stats import RenderStats
+
+
+def make_tiles(width: int, height: int, tile_size: int) -> list:
+    tiles = [(x, y, min(x + tile_size, width), min(y + tile_size, height))
+             for y in range(0, height, tile_size) for x in range(0, width, tile_size)]
+    # Сначала центр кадра, затем по расстоянию от него
+    return sorted(tiles, key=lambda tile: ((tile[0] + tile[2] - width) ** 2 + (tile[1] + tile[3] - height) ** 2))
+
+
+class SharedFramebuffer:
+    __slots__ = ('width', 'height', 'memory', 'array', 'counts', 'albedo', 'normals', 'depth', 'variance',
+                 'owner')
+
+    def __init__(self, width: int, height: int, name: str | None = None, aovs: bool = False):
+        self.width = width
+        self.height = height
+        self.owner = name is None
+        pixels = width * height
+        if self.owner:
+            self.memory = shared_memory.SharedMemory(create=True, size=pixels * (4 + 8 * aovs) * 4)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        # Цвет float32 и число сэмплов на пиксель int32 в одном сегменте
+        self.array = np.ndarray((height, width, 3), dtype=np.float32, buffer=self.memory.buf)
+        self.counts = np.ndarray((height, width), dtype=np.int32, buffer=self.memory.buf, offset=pixels * 3 * 4)
+        # AOV для денойзера за ними же: альбедо, нормаль и расстояние первого попадания и дисперсия яркости, float32
+        self.albedo = self.normals = self.depth = self.variance = None
+        if aovs:
+            self.albedo = np.ndarray((height, width, 3), dtype=np.float32, buffer=self.memory.buf,
+                                     offset=pixels * 4 * 4)
+            self.normals = np.ndarray((height, width, 3), dtype=np.float32, buffer=self.memory.buf,
+                                      offset=pixels * 7 * 4)
+            self.depth = np.ndarray((height, width), dtype=np.float32, buffer=self.memory.buf, offset=pixels * 10 * 4)
+            self.variance = np.ndarray((height, width), dtype=np.float32, buffer=self.memory.buf,
+                                       offset=pixels * 11 * 4)
+
+    def __repr__(self) -> str:
+        return f"SharedFramebuffer(name: {self.name}, size: {self.width}x{self.height})"
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    def close(self):
+        self.array = self.counts = self.albedo = self.normals = self.depth = self.variance = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+_worker = {}
+
+
+def _init_worker(renderer: BatchRenderer, name: str, width: int, height: int, sampler: AdaptiveSampler | None,
+                 aov_samples: int = 0, running=None, cancelled=None):
+    _worker['renderer'] = renderer
+    _worker['running'] = running
+    _worker['cancelled'] = cancelled
+    _worker['framebuffer'] = SharedFramebuffer(width, height, name, aov_samples > 0)
+    _worker['sampler'] = sampler
+    _worker['aov_samples'] = aov_samples
+
+
+def render_colors(renderer: BatchRenderer, sampler: AdaptiveSampler | None, tile: tuple, samples: int, seed: int,
+                  stream: int = 0) -> tuple:
+    # Цвета и число сэмплов тайла без записи в кадр; общее ядро TileRenderer, фермы и потоковой записи,
+    # поэтому их кадры с одним seed совпадают
+    x0, y0, x1, y1 = tile
+    if sampler is None:
+        colors = renderer.render(x0, y0, x1, y1, samples, seed, stream * samples)
+        return colors, np.full((y1 - y0, x1 - x0), samples, dtype=np.int32)
+    return sampler.render(renderer, x0, y0, x1, y1, seed, stream * sampler.max_samples)
+
+
+def render_tile(renderer: BatchRenderer, framebuffer: SharedFramebuffer, index: int, tile: tuple, samples: int,
+                sampler: AdaptiveSampler | None, seed: int, stream: int = 0, aov_samples: int = 0) -> int:
+    # Сэмплы зависят только от seed, пикселя и номера сэмпла, а не от тайла или процесса:
+    # проход stream берёт номера stream * samples .. (stream + 1) * samples - 1
+    x0, y0, x1, y1 = tile
+    rays = renderer.rays
+    start = perf_counter()
+    aovs = aov_samples and stream == 0
+    if sampler is None and aovs:
+        framebuffer.array[y0:y1, x0:x1], framebuffer.variance[y0:y1, x0:x1] = \
+            renderer.render(x0, y0, x1, y1, samples, seed, stream * samples, variance=True)
+        framebuffer.counts[y0:y1, x0:x1] = samples
+    else:
+        framebuffer.array[y0:y1, x0:x1], framebuffer.counts[y0:y1, x0:x1] = \
+            render_colors(renderer, sampler, tile, samples, seed, stream)
+    if aovs:
+        # AOV не зависят от прохода, поэтому считаются только в первом. Дисперсия есть только у фиксированного
+        # числа сэмплов; без неё (адаптивный режим, 1 сэмпл) денойзер оценивает шум по соседям
+        render_aovs(renderer, framebuffer, tile, aov_samples, seed)
+    if renderer.stats is not None:
+        renderer.stats.add_tile(tile, perf_counter() - start)
+    return renderer.rays - rays
+
+
+def render_aovs(renderer: BatchRenderer, framebuffer: SharedFramebuffer, tile: tuple, aov_samples: int, seed: int):
+    x0, y0, x1, y1 = tile
+    albedo, normals, depth = renderer.aovs(x0, y0, x1, y1, aov_samples, seed)
+    framebuffer.albedo[y0:y1, x0:x1] = albedo
+    framebuffer.normals[y0:y1, x0:x1] = normals
+    framebuffer.depth[y0:y1, x0:x1] = depth
+
+
+def _render_aovs(job: tuple) -> tuple:
+    tile, seed = job
+    render_aovs(_worker['renderer'], _worker['framebuffer'], tile, _worker['aov_samples'], seed)
+    return tile
+
+
+def _render_tile(job: tuple) -> tuple:
+    index, tile, samples, seed, stream = job
+    if _worker['running'] is not None:
+        # Пауза держит воркер до следующего тайла, после отмены оставшиеся в очереди тайлы пропускаются
+        _worker['running'].wait()
+        if _worker['cancelled'].is_set():
+            return tile, 0, None
+    renderer = _worker['renderer']
+    rays = render_tile(renderer, _worker['framebuffer'], index, tile, samples, _worker['sampler'], seed, stream,
+                       _worker['aov_samples'])
+    # Статистика воркера уходит вместе с тайлом и собирается в TileRenderer.stats
+    return tile, rays, renderer.stats.take() if renderer.stats is not None else None
+
+
+class TileRenderer:
+    __slots__ = ('renderer', 'width', 'height', 'tile_size', 'workers', 'sampler', 'aov_samples', 'framebuffer', 'rays',
+                 'stats', 'pool', 'running', 'cancelled')
+
+    def __init__(self, renderer: BatchRenderer, width: int, height: int, tile_size: int = 32,
+                 workers: int | None = None, sampler: AdaptiveSampler | None = None, aov_samples: int = 0):
+        self.renderer = renderer
+        self.sampler = sampler
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.workers = workers or cpu_count()
+        # Сэмплов на пиксель для AOV денойзера; 0 - буферы не создаются
+        self.aov_samples = aov_samples
+        self.framebuffer = SharedFramebuffer(width, height, aovs=aov_samples > 0)
+        self.rays = 0
+        # Сумма статистики всех процессов, если она включена у renderer
+        self.stats = RenderStats() if renderer.stats is not None else None
+        self.pool = None
+        # Пауза и отмена из другого потока, например из окна main.py; события общие с воркерами
+        context = get_context('spawn')
+        self.running = context.Event()
+        self.running.set()
+        self.cancelled = context.Event()
+
+    def __repr__(self) -> str:
+        return f"TileRenderer(size: {self.width}x{self.height}, tile_size: {self.tile_size}, workers: {self.workers})"
+
+    def render(self, samples: int, seed: int | None = None, stream: int = 0, done: np.ndarray | None = None):
+        # Тайлы раздаются из общей очереди по одному: освободившийся воркер сразу забирает следующий.
+        # stream различает повторные проходы с тем же seed, done[index] отмечает уже готовые тайлы
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        tiles = [(index, tile) for index, tile in enumerate(make_tiles(self.width, self.height, self.tile_size))
+                 if done is None or not done[index]]
+        if self.workers == 1:
+            for index, tile in tiles:
+                self.running.wait()
+                if self.cancelled.is_set():
+                    return
+                self.rays += render_tile(self.renderer, self.framebuffer, index, tile, samples, self.sampler, seed,
+                                         stream, self.aov_samples)
+                if self.stats is not None:
+                    self.stats.merge(self.renderer.stats.take())
+                yield tile
+            return
+        jobs = [(index, tile, samples, seed, stream) for index, tile in tiles]
+        for tile, rays, stats in self.start_pool().imap_unordered(_render_tile, jobs, chunksize=1):
+            if self.cancelled.is_set():
+                return
+            self.rays += rays
+            if stats is not None:
+                self.stats.merge(stats)
+            yield tile
+
+    def render_aovs(self, seed: int):
+        # Только буферы денойзера по всем тайлам: после возобновления контрольной точки их нет у тайлов,
+        # готовых до прерывания, и у всего кадра, если первый проход был в прошлом запуске
+        tiles = make_tiles(self.width, self.height, self.tile_size)
+        if self.workers == 1:
+            for tile in tiles:
+                render_aovs(self.renderer, self.framebuffer, tile, self.aov_samples, seed)
+                yield tile
+            return
+        yield from self.start_pool().imap_unordered(_render_aovs, [(tile, seed) for tile in tiles], chunksize=1)
+
+    def start_pool(self):
+        if self.pool is None:
+            # spawn, а не fork: форк процесса с уже инициализированным SDL может зависнуть.
+            # Пул живёт до close(), чтобы повторные проходы не запускали процессы заново
+            self.pool = get_context('spawn').Pool(self.workers, initializer=_init_worker,
+                                                  initargs=(self.renderer, self.framebuffer.name, self.width,
+                                                            self.height, self.sampler, self.aov_samples,
+                                                            self.running, self.cancelled))
+        return self.pool
+
+    @property
+    def paused(self) -> bool:
+        return not self.running.is_set()
+
+    def pause(self):
+        # Тайлы, которые уже рендерятся, дорисовываются; новые ждут resume()
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    def cancel(self):
+        # Насовсем: render() больше не отдаёт тайлов, прерванный проход остаётся неполным
+        self.cancelled.set()
+        self.running.set()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.framebuffer.close()
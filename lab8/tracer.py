@@ -0,0 +1,96 @@
+from math import sqrt, inf
+
+from scene import camera, skybox, objects, lights, light_samples, shadow_bias, max_reflections, min_throughput, \
+    roulette_depth, sequence
+from sequences import path_key_int, roulette_int, light_sample_int
+from vector import Vector
+from ray import Ray
+from bvh import ObjectBVH
+from light import LightSet, PointLight
+
+tree = ObjectBVH(objects)
+light_set = LightSet(lights)
+
+
+def shade_light(light, intersect: Vector, normal: Vector, obj) -> Vector:
+    if isinstance(light, PointLight):
+        offset = light.position.sub(intersect)
+        squared = offset.vdot(offset)
+        distance = sqrt(squared)
+        light_dir = offset.scale(1 / distance)
+        falloff = 1 / max(squared, 1e-8)
+    else:
+        light_dir = -light.direction
+        distance, falloff = inf, 1.0
+
+    # Ambient component
+    color = obj.ambient_color.mul(light.ambient_color)
+
+    # Diffuse component
+    normal_dot_light = normal.vdot(light_dir)
+    color.imadd(obj.diffuse_color.mul(light.diffuse_color), max(0, normal_dot_light) * light.strength)
+
+    # Specular component
+    view_dir = camera.position.sub(intersect).normalize()
+    reflect_dir = normal.scale(2 * normal_dot_light).sub(light_dir)
+    specular_intensity = max(0, view_dir.vdot(reflect_dir)) ** obj.shininess
+    color.imadd(obj.specular_color.mul(light.specular_color), specular_intensity)
+
+    # Calculate shadows
+    light_ray = Ray(intersect.madd(normal, shadow_bias), light_dir)
+    if light_ray.occluded(tree, distance):
+        return color.scale(0.1 / light.strength * falloff)
+    return color.scale(normal_dot_light * light.strength * falloff)
+
+
+def trace_ray(ray: Ray, key: int = 0, depth: int = 0) -> tuple:
+    # key и depth нужны только для случайного выбора источников, когда их больше light_samples
+    color = Vector(0, 0, 0)
+    intersect, obj = ray.cast(tree)
+    normal = False
+    if intersect:
+        normal = obj.get_normal(intersect)
+        if len(light_set) <= light_samples:
+            for light in light_set.lights:
+                color += shade_light(light, intersect, normal, obj)
+        else:
+            for sample in range(light_samples):
+                index = light_set.sample_int(light_sample_int(key, depth, sample))
+                color.imadd(shade_light(light_set.lights[index], intersect, normal, obj),
+                            1 / float(light_set.pdf[index]))
+            color = color.scale(1 / light_samples)
+    else:
+        color = skybox.get_image_coords(ray.direction)
+    return color, intersect, normal, obj
+
+
+def trace_path(ray: Ray, key: int) -> Vector:
+    # Итеративный интегратор: освещение в каждой точке пути берётся с весом throughput - произведением
+    # reflectivity уже пройденных поверхностей; key - ключ пути для русской рулетки
+    color = Vector(0, 0, 0)
+    throughput = 1.0
+    for depth in range(max_reflections + 1):
+        new_color, intersect, normal, obj = trace_ray(ray, key, depth)
+        color.imadd(new_color, throughput)
+        if not intersect or depth == max_reflections:
+            break
+        throughput *= obj.reflectivity
+        if throughput < min_throughput:
+            break
+        if depth >= roulette_depth:
+            survival = min(throughput, 1)
+            if roulette_int(key, depth) >= survival:
+                break
+            throughput /= survival
+        direction = ray.direction.reflect(normal)
+        ray = Ray(intersect.madd(direction, shadow_bias), direction)
+    return color
+
+
+def trace_pixel(x: int, y: int, samples: int, seed: int = 0) -> Vector:
+    color_sum = Vector(0, 0, 0)
+    for index in range(samples):
+        dx, dy, lens = sequence.point(x, y, index, seed)
+        ray = camera.get_direction(Vector(x + dx - 0.5, y + dy - 0.5), lens)
+        color_sum += trace_path(ray, path_key_int(seed, x, y, index))
+    return color_sum.scale(1 / samples)
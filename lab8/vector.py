@@ -14,34 +14,34 @@ class Vector:
         return f"Vector(x: {self.x}, y: {self.y}, z: {self.z})"
 
     def __add__(self, addend: Vector | int | float) -> Vector:
-        if type(addend) == int or type(addend) == float:
-            return Vector(self.x + addend, self.y + addend, self.z + addend)
-        elif type(addend) == Vector:
+        if type(addend) is Vector:
             return Vector(self.x + addend.x, self.y + addend.y, self.z + addend.z)
+        elif isinstance(addend, (int, float)):
+            return Vector(self.x + addend, self.y + addend, self.z + addend)
         print("Adding a vector with an unsupported variable type!")
         return Vector(self.x, self.y, self.z)
 
     def __sub__(self, subtrahend: Vector | int | float) -> Vector:
-        if type(subtrahend) == int or type(subtrahend) == float:
-            return Vector(self.x - subtrahend, self.y - subtrahend, self.z - subtrahend)
-        elif type(subtrahend) == Vector:
+        if type(subtrahend) is Vector:
             return Vector(self.x - subtrahend.x, self.y - subtrahend.y, self.z - subtrahend.z)
+        elif isinstance(subtrahend, (int, float)):
+            return Vector(self.x - subtrahend, self.y - subtrahend, self.z - subtrahend)
         print("Subtracting a vector with an unsupported variable type!")
         return Vector(self.x, self.y, self.z)
 
     def __mul__(self, factor: Vector | int | float) -> Vector:
-        if type(factor) == int or type(factor) == float:
+        if isinstance(factor, (int, float)):
             return Vector(self.x * factor, self.y * factor, self.z * factor)
-        elif type(factor) == Vector:
+        elif type(factor) is Vector:
             return Vector(self.x * factor.x, self.y * factor.y, self.z * factor.z)
         print("Multiplying a vector with an unsupported variable type!")
         return Vector(self.x, self.y, self.z)
 
     def __truediv__(self, divisor: Vector | int | float) -> Vector:
-        if type(divisor) == int or type(divisor) == float:
-            return Vector(self.x / (divisor + 0.00000001), self.y / (divisor + 0.00000001),
-                          self.z / (divisor + 0.00000001))
-        elif type(divisor) == Vector:
+        if isinstance(divisor, (int, float)):
+            inverse = 1 / (divisor + 0.00000001)
+            return Vector(self.x * inverse, self.y * inverse, self.z * inverse)
+        elif type(divisor) is Vector:
             return Vector(self.x / (divisor.x + 0.00000001), self.y / (divisor.y + 0.00000001),
                           self.z / (divisor.z + 0.00000001))
         print("Dividing a vector with an unsupported variable type!")
@@ -95,6 +95,34 @@ class Vector:
         print("Comparing a vector with an unsupported variable type!")
         return False
 
+    def __iadd__(self, addend: Vector | int | float) -> Vector:
+        if type(addend) is Vector:
+            self.x += addend.x
+            self.y += addend.y
+            self.z += addend.z
+            return self
+        elif isinstance(addend, (int, float)):
+            self.x += addend
+            self.y += addend
+            self.z += addend
+            return self
+        print("Adding a vector with an unsupported variable type!")
+        return self
+
+    def __imul__(self, factor: Vector | int | float) -> Vector:
+        if isinstance(factor, (int, float)):
+            self.x *= factor
+            self.y *= factor
+            self.z *= factor
+            return self
+        elif type(factor) is Vector:
+            self.x *= factor.x
+            self.y *= factor.y
+            self.z *= factor.z
+            return self
+        print("Multiplying a vector with an unsupported variable type!")
+        return self
+
     def __neg__(self) -> Vector:
         return Vector(-self.x, -self.y, -self.z)
 
@@ -108,10 +136,10 @@ class Vector:
         return int(self.magnitude())
 
     def dot(self, factor: Vector | int | float) -> int | float:
-        if type(factor) == int or type(factor) == float:
-            return self.x * factor + self.y * factor + self.z * factor
-        elif type(factor) == Vector:
+        if type(factor) is Vector:
             return self.x * factor.x + self.y * factor.y + self.z * factor.z
+        elif isinstance(factor, (int, float)):
+            return self.x * factor + self.y * factor + self.z * factor
         print("Multiplying a vector with an unsupported variable type!")
         return self.x + self.y + self.z
 
@@ -122,11 +150,42 @@ class Vector:
     def magnitude(self) -> int | float:
         return sqrt(self.x * self.x + self.y * self.y + self.z * self.z)
 
+    # Быстрые методы без проверки типа аргумента: для горячих циклов трассировщика
+
+    def add(self, other: Vector) -> Vector:
+        return Vector(self.x + other.x, self.y + other.y, self.z + other.z)
+
+    def sub(self, other: Vector) -> Vector:
+        return Vector(self.x - other.x, self.y - other.y, self.z - other.z)
+
+    def mul(self, other: Vector) -> Vector:
+        return Vector(self.x * other.x, self.y * other.y, self.z * other.z)
+
+    def scale(self, factor: float) -> Vector:
+        return Vector(self.x * factor, self.y * factor, self.z * factor)
+
+    def madd(self, other: Vector, factor: float) -> Vector:
+        # self + other * factor без промежуточного вектора
+        return Vector(self.x + other.x * factor, self.y + other.y * factor, self.z + other.z * factor)
+
+    def imadd(self, other: Vector, factor: float) -> Vector:
+        self.x += other.x * factor
+        self.y += other.y * factor
+        self.z += other.z * factor
+        return self
+
+    def vdot(self, other: Vector) -> float:
+        return self.x * other.x + self.y * other.y + self.z * other.z
+
     def normalize(self) -> Vector:
-        return self / self.magnitude()
+        magnitude = sqrt(self.x * self.x + self.y * self.y + self.z * self.z)
+        if magnitude == 0:
+            return Vector(0.0, 0.0, 0.0)
+        inverse = 1 / magnitude
+        return Vector(self.x * inverse, self.y * inverse, self.z * inverse)
 
     def reflect(self, normal: Vector) -> Vector:
-        return self - normal * (self.dot(normal)) * 2
+        return self.madd(normal, -2 * self.vdot(normal))
 
     def to_rgb(self) -> tuple:
         r, g, b = self.x, self.y, self.z